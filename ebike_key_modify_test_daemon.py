@@ -1,19 +1,31 @@
+import binascii
+import collections
+import json
 import logging
+import os
+import select
 import socket
+import struct
 import sys
 import threading
 import time
+import weakref
 from logging.handlers import RotatingFileHandler
 
-import RPi.GPIO as GPIO
-import numpy as np
 import serial
 
 cur_version = sys.version_info
 if cur_version >= (3, 0):
     import queue
 else:
-    import Queue
+    import Queue as queue
+
+if cur_version >= (3, 3):
+    monotonic = time.monotonic
+    replace_file = os.replace
+else:
+    monotonic = time.time
+    replace_file = os.rename
 
 # communication commands and its default values
 com_com = {
@@ -33,6 +45,7 @@ com_com = {
     "Button": "None",
     "SignalPeriod": 0,
     "Signal": "Stop",
+    "Hazard": "Off",
 }
 
 # signal names
@@ -54,6 +67,10 @@ var_button_plus = "button_plus"
 var_button_minus = "button_minus"
 var_button_option = "button_option"
 
+# pin levels, same values as RPi.GPIO.HIGH and RPi.GPIO.LOW
+PIN_HIGH = 1
+PIN_LOW = 0
+
 # GPIO pins and signals mapping
 # pin numbers are BOARD pin number
 signal_pin_array = [
@@ -85,6 +102,11 @@ button_pin_array = [
     {var_button_plus: 32},
 ]
 
+# BOARD pin each channel of the hardware PWM comes out on with
+# dtoverlay=pwm-2chan. pin 12 takes the place of the charging signal,
+# channel 1 is not usable as pin 35 is a button.
+hardware_pwm_pins = {0: 12, 1: 35}
+
 com_setting = {}
 
 mode_options = ["1wire", "GPIO"]
@@ -101,8 +123,73 @@ controller_malfunction_options = ["On", "Off"]
 open_phase_malfunction_options = ["On", "Off"]
 button_options = ["PressPlus", "ReleasePlus", "PressMinus", "ReleaseMinus", "PressOption", "ReleaseOption", "None"]
 signal_options = ["Start", "Stop"]
-
+hazard_options = ["On", "Off"]
+
+# heavy modules are imported on first use, these can be warmed up in the
+# background at startup instead
+prewarm_options = ["numpy", "cv2", "camera"]
+log_level_options = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+
+# binary protocol, negotiated with the BINARY text command. all fields are
+# little endian.
+# frame: magic 0xA5, command id, value type, sequence (u16), value, crc16
+# value: int32 for binary_value_int, length byte + utf-8 for binary_value_text
+# ack:   magic 0x5A, sequence (u16), status, crc16
+# crc16 is CRC-16/CCITT (initial value 0xFFFF) over everything before it.
+# command id is the index in binary_commands, binary_text_mode_id switches
+# back to the text protocol.
+binary_commands = ["Mode", "Speed", "CruiserMode", "RatedVoltage", "Volt", "Status", "Gear", "Beam",
+                   "TurnSignalLamp", "HallMalfunction", "GripShiftMalfunction", "ControllerMalfunction",
+                   "OpenPhaseMalfunction", "Button", "SignalPeriod", "Signal", "Hazard"]
+binary_text_mode_id = 0xFF
+binary_frame_magic = 0xA5
+binary_ack_magic = 0x5A
+binary_frame_header = struct.Struct('<BBBH')
+binary_ack_header = struct.Struct('<BHB')
+binary_int_value = struct.Struct('<i')
+binary_crc = struct.Struct('<H')
+binary_value_int = 0
+binary_value_text = 1
+binary_status_ok = 0
+binary_status_fail = 1
+binary_status_error = 2
+
+# 1-wire frame on the one_wire pin: a sync low, then the frame bytes MSB
+# first. every bit is a high phase followed by a low phase, their lengths in
+# seconds tell a 0 from a 1. frames follow each other without a gap.
+# frame: customer code, model code, status flags, speed (u16 big endian),
+# volt, 5 reserved bytes, xor of all bytes before it
+one_wire_sync = 0.05
+one_wire_bit_timing = {0: (0.0005, 0.001), 1: (0.001, 0.0005)}
+one_wire_customer_code = 0x08
+one_wire_model_code = 0x61
+one_wire_reserved_bytes = 5
+# bit n of the status flags byte is set while com_setting has that value
+one_wire_status_flags = [("ControllerMalfunction", "On"), ("HallMalfunction", "On"),
+                         ("GripShiftMalfunction", "On"), ("OpenPhaseMalfunction", "On"),
+                         ("CruiserMode", "On")]
+# a frame is only rebuilt when one of these changes
+one_wire_fields = ["Speed", "Volt"] + [command for command, value in one_wire_status_flags]
+
+# stages a command line is timestamped at, in order
+latency_stages = ["received", "parsed", "enqueued", "dequeued", "applied", "acked"]
+
+# last-writer-wins commands, a pending update is replaced by a newer one
+coalescing_commands = ["Speed", "Volt", "SignalPeriod"]
+
+g_gpio = None
 g_pwm = None
+# frequency g_pwm was last set to
+g_pwm_frequency = None
+g_one_wire = None
+# (sysfs root, chip, channel) of the hardware PWM driving the speed signal,
+# None while the speed signal uses the gpio backend's PWM
+g_speed_pwm_sysfs = None
+# BOARD pins handed over to the hardware PWM, left out of the gpio setup and
+# the pin table
+g_reserved_pins = set()
+# how long to wait for the kernel to create an exported PWM channel
+g_pwm_export_timeout = 1.0
 g_pwm_period = 61
 g_max_speed = 65535
 g_valid_max_speed = 75
@@ -114,168 +201,686 @@ g_min_voltage = 0
 g_threads = []
 g_queue = False
 g_lock = None
-g_event = None
-g_semaphore = None
 g_threads_error_flag = False
+g_supervisor = None
+# a command still running after g_command_timeout seconds is failed and its
+# worker replaced, restarts back off from g_restart_backoff up to
+# g_restart_backoff_max seconds
+g_command_timeout = 5.0
+g_restart_backoff = 0.1
+g_restart_backoff_max = 5.0
+g_stats = None
+g_periodic_signals = None
+# per session state, keyed by the session's port. background jobs hold
+# their port, so its lock lives as long as they can still report to it.
+g_binary_ports = set()
+g_serial_locks = weakref.WeakKeyDictionary()
+g_snapshots = {}
+g_ack_queues = {}
+g_listen_backlog = 8
+# tagged commands a session may have waiting for their ack before reading
+# from the port stops
+g_pipeline_depth = 64
+# every session uploads and plays its own scenario
+g_scenarios = {}
+g_max_scenario_steps = 1000
+# SIGNALCHECK and SWEEP drive the pins directly, one runs at a time and only
+# the session that started it can abort it
+g_signal_check_thread = None
+g_signal_check_port = None
+g_signal_check_abort = threading.Event()
+# hold times of SIGNALCHECK in seconds, set in ms with SIGNALCHECK hold=3000
+signal_check_defaults = {"hold": 3.0, "gap": 1.0, "press": 0.6, "long_press": 1.0, "sweep_dwell": 0.1}
+g_sweep_thread = None
+g_sweep_port = None
+g_sweep_abort = threading.Event()
+# SWEEP arguments, speeds in km/h and dwell in ms, end defaults to the
+# maximum valid speed of the rated voltage
+sweep_defaults = {"start": 0, "end": 0, "steps": 76, "dwell": 100, "report": 10}
+g_numpy = None
+g_camera = None
+g_camera_lock = threading.Lock()
+g_camera_device = 0
+# TAKESNAPSHOT arguments, width/height 0 keep the camera resolution
+snapshot_defaults = {"width": 0, "height": 0, "quality": 90, "chunk": 4096}
+g_max_snapshot_chunk = 65536
+g_log_listener = None
+g_command_context = threading.local()
+g_pin_table = {}
+g_pin_levels = {}
+g_speed_duty_luts = {}
+g_speed_duty_lut = []
+# duty cycle the speed pin is driven with, None while no PWM runs
+g_speed_duty = None
+# output changes that wait for a hold time run from timers instead of
+# sleeping on the worker, which every session shares. name -> Timer
+g_deferred_outputs = {}
+# a released button stays released this long before the next press
+g_button_release_hold = 0.4
+g_button_release_until = 0.0
+g_state_versions = None
+g_state_persister = None
+# a burst of changes is written to the state file once
+g_state_save_interval = 0.05
+g_serial_read_timeout = 0.5
+
+
+class RPiGPIOBackend(object):
+    # pins and PWM driven through RPi.GPIO, BOARD pin numbering
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self._gpio = GPIO
+
+    def setmode(self):
+        self._gpio.setmode(self._gpio.BOARD)
+
+    def setup_output(self, pin_num, initial=None):
+        # with initial the pin is driven to that level as it becomes an
+        # output, without passing through low
+        if initial is None:
+            self._gpio.setup(pin_num, self._gpio.OUT)
+        else:
+            self._gpio.setup(pin_num, self._gpio.OUT, initial=initial)
 
+    def output(self, pin_num, level):
+        self._gpio.output(pin_num, level)
 
-def get_value_in_dict_from_list(key):
-    return [lst for lst in signal_pin_array if key in lst][0].get(key)
+    def input(self, pin_num):
+        # reads back the level an output pin is driven to
+        return self._gpio.input(pin_num)
 
+    def pwm(self, pin_num, frequency):
+        return self._gpio.PWM(pin_num, frequency)
 
-def gpio_speed_generation():
-    app_log.debug("gpio_speed_generation")
-    global g_pwm
-    global g_pwm_period
-    global g_valid_max_speed
+    def watch_rising_edges(self, pin_num, callback):
+        # callback gets the monotonic time of every rising edge on an input
+        self._gpio.setup(pin_num, self._gpio.IN)
+        self._gpio.add_event_detect(pin_num, self._gpio.RISING, callback=lambda channel: callback(monotonic()))
 
-    g_pwm = GPIO.PWM([lst for lst in speed_pin_array if var_speed in lst][0].get(var_speed), g_pwm_period)
+    def unwatch(self, pin_num):
+        self._gpio.remove_event_detect(pin_num)
 
-    # duty_cycle = float(int(com_setting["Speed"]) * (50.0 - 5.0) / (g_valid_max_speed - 3)  + 5.0)
-    duty_cycle = float(int(com_setting["Speed"]) * (50.0 - 4.67) / g_valid_max_speed + 4.67)
-    app_log.debug("duty_cycle: %s", duty_cycle)
-    if duty_cycle > 100.0:
-        duty_cycle = 100.0
-    g_pwm.start(duty_cycle)
-    time.sleep(0.001)
 
+class SimulatedPWM(object):
+    # same interface as RPi.GPIO.PWM, every call is recorded by the backend
 
-def gpio_status_generation():
-    app_log.debug("gpio_status_generation")
-    if com_setting["Status"] == "Park":
-        GPIO.output(get_value_in_dict_from_list(var_parking), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_backward_gear), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_low_gear), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_medium_gear), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_high_gear), GPIO.LOW)
-    elif com_setting["Status"] == "Ready":
-        GPIO.output(get_value_in_dict_from_list(var_parking), GPIO.HIGH)
-        GPIO.output(get_value_in_dict_from_list(var_backward_gear), GPIO.LOW)
-        if com_setting["Gear"] == "High":
-            GPIO.output(get_value_in_dict_from_list(var_low_gear), GPIO.LOW)
-            GPIO.output(get_value_in_dict_from_list(var_medium_gear), GPIO.LOW)
-            GPIO.output(get_value_in_dict_from_list(var_high_gear), GPIO.HIGH)
-        elif com_setting["Gear"] == "Medium":
-            GPIO.output(get_value_in_dict_from_list(var_low_gear), GPIO.LOW)
-            GPIO.output(get_value_in_dict_from_list(var_medium_gear), GPIO.HIGH)
-            GPIO.output(get_value_in_dict_from_list(var_high_gear), GPIO.LOW)
-        elif com_setting["Gear"] == "Low":
-            GPIO.output(get_value_in_dict_from_list(var_low_gear), GPIO.HIGH)
-            GPIO.output(get_value_in_dict_from_list(var_medium_gear), GPIO.LOW)
-            GPIO.output(get_value_in_dict_from_list(var_high_gear), GPIO.LOW)
-        else:
-            GPIO.output(get_value_in_dict_from_list(var_low_gear), GPIO.LOW)
-            GPIO.output(get_value_in_dict_from_list(var_medium_gear), GPIO.LOW)
-            GPIO.output(get_value_in_dict_from_list(var_high_gear), GPIO.LOW)
+    def __init__(self, backend, pin_num, frequency):
+        self._backend = backend
+        self.pin_num = pin_num
+        self.frequency = frequency
+        self.duty_cycle = None
+        self._backend.record(pin_num, "frequency", frequency)
 
+    def start(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self._backend.record(self.pin_num, "start", duty_cycle)
 
-def gpio_gear_generation():
-    app_log.debug("gpio_gear_generation")
+    def ChangeDutyCycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self._backend.record(self.pin_num, "duty_cycle", duty_cycle)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+        self._backend.record(self.pin_num, "frequency", frequency)
+
+    def stop(self):
+        self.duty_cycle = None
+        self._backend.record(self.pin_num, "stop", None)
+
+
+class SimulatedGPIOBackend(object):
+    # in-memory pins for running the daemon off-board. every pin level and
+    # PWM change is kept in transitions as (monotonic time, pin, event, value)
+
+    def __init__(self, max_transitions=100000):
+        self.levels = {}
+        self.pwms = {}
+        self.transitions = collections.deque(maxlen=max_transitions)
+        self._lock = threading.Lock()
+
+    def record(self, pin_num, event, value):
+        with self._lock:
+            self.transitions.append((monotonic(), pin_num, event, value))
+
+    def setmode(self):
+        pass
+
+    def setup_output(self, pin_num, initial=None):
+        self.levels[pin_num] = initial
+        self.record(pin_num, "setup", initial)
+
+    def output(self, pin_num, level):
+        self.levels[pin_num] = level
+        self.record(pin_num, "level", level)
+
+    def input(self, pin_num):
+        return self.levels.get(pin_num)
+
+    def pwm(self, pin_num, frequency):
+        self.pwms[pin_num] = SimulatedPWM(self, pin_num, frequency)
+        return self.pwms[pin_num]
+
+
+gpio_backends = {
+    "rpi": RPiGPIOBackend,
+    "sim": SimulatedGPIOBackend,
+}
+
+
+class SysfsPWM(object):
+    # same interface as RPi.GPIO.PWM on a hardware PWM channel of the kernel
+    # pwm sysfs interface, the SoC times the waveform so it does not jitter
+    # with the CPU load and costs no CPU between changes
+
+    def __init__(self, root, chip, channel, frequency):
+        chip_path = os.path.join(root, "pwmchip%d" % chip)
+        self.path = os.path.join(chip_path, "pwm%d" % channel)
+        if not os.path.isdir(self.path):
+            self._write_file(os.path.join(chip_path, "export"), channel)
+            # udev creates the channel directory after the export returns
+            deadline = monotonic() + g_pwm_export_timeout
+            while not os.path.isdir(self.path):
+                if monotonic() > deadline:
+                    raise IOError("pwm channel %s not exported" % self.path)
+                time.sleep(0.01)
+        self.frequency = frequency
+        self.duty_cycle = None
+        self._period = None
+        # a previous run may have left a duty cycle behind
+        with open(os.path.join(self.path, "duty_cycle")) as fd:
+            self._duty = int(fd.read().strip() or 0)
+
+    def _write_file(self, path, value):
+        with open(path, "w") as fd:
+            fd.write("%d\n" % value)
+
+    def _write(self, name, value):
+        self._write_file(os.path.join(self.path, name), value)
+
+    def _set_period(self, frequency):
+        # the kernel refuses a period shorter than the duty cycle, so the
+        # duty cycle is shortened first
+        period = int(round(1e9 / frequency))
+        duty = int(round(period * (self.duty_cycle or 0) / 100.0))
+        if duty < self._duty:
+            self._write("duty_cycle", duty)
+            self._duty = duty
+        self._write("period", period)
+        self._period = period
+
+    def _set_duty(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+        self._duty = int(round(self._period * duty_cycle / 100.0))
+        self._write("duty_cycle", self._duty)
+
+    def start(self, duty_cycle):
+        self._set_period(self.frequency)
+        self._set_duty(duty_cycle)
+        self._write("enable", 1)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self._set_duty(duty_cycle)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+        self._set_period(frequency)
+        self._set_duty(self.duty_cycle or 0)
+
+    def stop(self):
+        self._write("enable", 0)
+        self.duty_cycle = None
+
+
+def pwm_jitter_stats(edges, frequency):
+    # deviation of the periods between rising edges from the nominal period,
+    # in us. None when there are too few edges.
+    periods = [edges[i] - edges[i - 1] for i in range(1, len(edges))]
+    if len(periods) < 2:
+        return None
+    nominal = 1.0 / frequency
+    mean = sum(periods) / len(periods)
+    errors = sorted([abs(period - nominal) * 1e6 for period in periods])
+    variance = sum([(period - mean) ** 2 for period in periods]) / len(periods)
+    return {"periods": len(periods), "mean": mean * 1e6, "stddev": variance ** 0.5 * 1e6,
+            "p99": errors[int(0.99 * (len(errors) - 1))], "max": errors[-1]}
+
+
+def measure_pwm_jitter(app_log, input_pin, seconds):
+    # run the speed PWM at 50% and time its rising edges on input_pin, which
+    # has to be wired to the pin the PWM comes out on. the edge timestamps
+    # carry the latency of the edge callback, the same for both backends.
+    if not hasattr(g_gpio, "watch_rising_edges"):
+        app_log.error("gpio backend can not watch edges")
+        return None
+    edges = []
+    pwm = speed_pwm_channel()
+    pwm.start(50.0)
+    g_gpio.watch_rising_edges(input_pin, edges.append)
+    try:
+        time.sleep(seconds)
+    finally:
+        g_gpio.unwatch(input_pin)
+        pwm.stop()
+    return pwm_jitter_stats(edges, g_pwm_frequency)
+
+
+def speed_pwm(frequency):
+    # PWM for the speed signal, on the hardware PWM when one is configured
+    if g_speed_pwm_sysfs is not None:
+        root, chip, channel = g_speed_pwm_sysfs
+        try:
+            return SysfsPWM(root, chip, channel, frequency)
+        except (IOError, OSError) as e:
+            app_log.error("hardware pwm failed, falling back to gpio pwm: %s", e)
+    return g_gpio.pwm(g_pin_table[var_speed], frequency)
+
+
+def init_pin_table():
+    global g_pin_table
+    global g_pin_levels
+
+    # compile the pin arrays into signal name -> pin number lookups once
+    g_pin_table = {}
+    for pin_array in [signal_pin_array, button_pin_array, speed_pin_array, one_wire_pin_array]:
+        for pin_pair in pin_array:
+            for pin, pin_num in pin_pair.items():
+                if pin_num not in g_reserved_pins:
+                    g_pin_table[pin] = pin_num
+    # last level written to each pin, None until the pin is first driven
+    g_pin_levels = {}
+    for pin_num in g_pin_table.values():
+        g_pin_levels[pin_num] = None
+
+
+def gpio_write_levels(levels):
+    global g_lock
+
+    # drive only the pins whose level differs from the last applied one
+    g_lock.acquire()
+    try:
+        for pin, level in levels.items():
+            pin_num = g_pin_table[pin]
+            if g_pin_levels[pin_num] != level:
+                g_gpio.output(pin_num, level)
+                g_pin_levels[pin_num] = level
+                g_state_versions.bump("Pin", pin)
+    finally:
+        g_lock.release()
+
+
+class PeriodicSignalScheduler(object):
+    # toggles the pins of every periodic channel from one thread. each edge
+    # is scheduled half a period after the previous edge's deadline rather
+    # than after the time it was written, so the waveform does not drift.
+    # g_lock is always taken before the scheduler's own condition.
+
+    def __init__(self):
+        self._channels = {}
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def set_channel(self, name, pins, period):
+        # period in ms. when only the period of a running channel changes it
+        # keeps its level and the next edge follows the last one by the new
+        # half period, so there is no glitch on the pins.
+        g_lock.acquire()
+        try:
+            with self._condition:
+                now = monotonic()
+                half_period = period / 2000.0
+                channel = self._channels.get(name)
+                if channel is not None and channel["pins"] == pins:
+                    channel["half_period"] = half_period
+                    channel["deadline"] = max(channel["edge"] + half_period, now)
+                else:
+                    gpio_write_levels(dict([(pin, PIN_HIGH) for pin in pins]))
+                    self._channels[name] = {"pins": pins, "half_period": half_period, "level": PIN_HIGH,
+                                            "edge": now, "deadline": now + half_period}
+                self._condition.notify()
+        finally:
+            g_lock.release()
+
+    def clear_channel(self, name):
+        with self._condition:
+            self._channels.pop(name, None)
+            self._condition.notify()
+
+    def clear(self):
+        with self._condition:
+            self._channels.clear()
+            self._condition.notify()
+
+    def active_pins(self):
+        with self._condition:
+            pins = set()
+            for channel in self._channels.values():
+                pins.update(channel["pins"])
+            return pins
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    deadlines = [channel["deadline"] for channel in self._channels.values()]
+                    timeout = min(deadlines) - monotonic() if len(deadlines) > 0 else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+            g_lock.acquire()
+            try:
+                with self._condition:
+                    now = monotonic()
+                    for channel in self._channels.values():
+                        if channel["deadline"] > now:
+                            continue
+                        # edges missed while the thread was late are skipped,
+                        # the phase is kept
+                        missed = int((now - channel["deadline"]) / channel["half_period"])
+                        if missed % 2 == 0:
+                            channel["level"] = PIN_LOW if channel["level"] == PIN_HIGH else PIN_HIGH
+                        channel["edge"] = channel["deadline"] + missed * channel["half_period"]
+                        channel["deadline"] = channel["edge"] + channel["half_period"]
+                        gpio_write_levels(dict([(pin, channel["level"]) for pin in channel["pins"]]))
+            finally:
+                g_lock.release()
+
+
+def gear_signal_levels():
     if com_setting["Gear"] == "High":
-        GPIO.output(get_value_in_dict_from_list(var_low_gear), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_medium_gear), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_high_gear), GPIO.HIGH)
+        return {var_low_gear: PIN_LOW, var_medium_gear: PIN_LOW, var_high_gear: PIN_HIGH}
     elif com_setting["Gear"] == "Medium":
-        GPIO.output(get_value_in_dict_from_list(var_low_gear), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_medium_gear), GPIO.HIGH)
-        GPIO.output(get_value_in_dict_from_list(var_high_gear), GPIO.LOW)
+        return {var_low_gear: PIN_LOW, var_medium_gear: PIN_HIGH, var_high_gear: PIN_LOW}
     elif com_setting["Gear"] == "Low":
-        GPIO.output(get_value_in_dict_from_list(var_low_gear), GPIO.HIGH)
-        GPIO.output(get_value_in_dict_from_list(var_medium_gear), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_high_gear), GPIO.LOW)
+        return {var_low_gear: PIN_HIGH, var_medium_gear: PIN_LOW, var_high_gear: PIN_LOW}
     else:
-        GPIO.output(get_value_in_dict_from_list(var_low_gear), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_medium_gear), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_high_gear), GPIO.LOW)
+        return {var_low_gear: PIN_LOW, var_medium_gear: PIN_LOW, var_high_gear: PIN_LOW}
 
 
-def gpio_beam_generation():
-    app_log.debug("gpio_beam_generation")
+def status_signal_levels():
+    if com_setting["Status"] == "Ready":
+        levels = {var_parking: PIN_HIGH, var_backward_gear: PIN_LOW}
+        levels.update(gear_signal_levels())
+    else:
+        levels = status_termination_levels()
+    return levels
+
+
+def beam_signal_levels():
     if com_setting["Beam"] == "High":
-        GPIO.output(get_value_in_dict_from_list(var_low_beam), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_high_beam), GPIO.HIGH)
+        return {var_low_beam: PIN_LOW, var_high_beam: PIN_HIGH}
     elif com_setting["Beam"] == "Low":
-        GPIO.output(get_value_in_dict_from_list(var_low_beam), GPIO.HIGH)
-        GPIO.output(get_value_in_dict_from_list(var_high_beam), GPIO.LOW)
+        return {var_low_beam: PIN_HIGH, var_high_beam: PIN_LOW}
     else:
-        GPIO.output(get_value_in_dict_from_list(var_low_beam), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_high_beam), GPIO.LOW)
+        return {var_low_beam: PIN_LOW, var_high_beam: PIN_LOW}
 
 
-def gpio_turn_signal_lamp_generation():
-    app_log.debug("gpio_turn_signal_lamp_generation")
+def turn_signal_lamp_levels():
     if com_setting["TurnSignalLamp"] == "Left":
-        GPIO.output(get_value_in_dict_from_list(var_turn_right), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_turn_left), GPIO.HIGH)
+        return {var_turn_right: PIN_LOW, var_turn_left: PIN_HIGH}
     elif com_setting["TurnSignalLamp"] == "Right":
-        GPIO.output(get_value_in_dict_from_list(var_turn_right), GPIO.HIGH)
-        GPIO.output(get_value_in_dict_from_list(var_turn_left), GPIO.LOW)
+        return {var_turn_right: PIN_HIGH, var_turn_left: PIN_LOW}
     else:
-        GPIO.output(get_value_in_dict_from_list(var_turn_right), GPIO.LOW)
-        GPIO.output(get_value_in_dict_from_list(var_turn_left), GPIO.LOW)
+        return {var_turn_right: PIN_LOW, var_turn_left: PIN_LOW}
 
 
-def gpio_button_signal_generation():
-    app_log.debug("gpio_button_signal_generation")
+def hazard_signal_levels():
+    if com_setting["Hazard"] == "On":
+        return {var_dangerous: PIN_HIGH}
+    else:
+        return {var_dangerous: PIN_LOW}
+
+
+def button_signal_levels():
+    # buttons are active low
     if com_setting["Button"] == "PressPlus":
-        GPIO.output(button_pin_array[2][var_button_plus], GPIO.LOW)
-        GPIO.output(button_pin_array[1][var_button_option], GPIO.HIGH)
-        GPIO.output(button_pin_array[0][var_button_minus], GPIO.HIGH)
-        # time.sleep(0.4)
-        # GPIO.output(button_pin_array[2][var_button_plus], GPIO.HIGH)
-        # GPIO.output(button_pin_array[1][var_button_option], GPIO.HIGH)
-        # GPIO.output(button_pin_array[0][var_button_minus], GPIO.HIGH)
-        # time.sleep(0.4)
-    elif com_setting["Button"] == "ReleasePlus":
-        # GPIO.output(button_pin_array[2][var_button_plus], GPIO.LOW)
-        # GPIO.output(button_pin_array[1][var_button_option], GPIO.HIGH)
-        # GPIO.output(button_pin_array[0][var_button_minus], GPIO.HIGH)
-        # time.sleep(1)
-        GPIO.output(button_pin_array[2][var_button_plus], GPIO.HIGH)
-        GPIO.output(button_pin_array[1][var_button_option], GPIO.HIGH)
-        GPIO.output(button_pin_array[0][var_button_minus], GPIO.HIGH)
-        # time.sleep(0.4)
+        return {var_button_plus: PIN_LOW, var_button_option: PIN_HIGH, var_button_minus: PIN_HIGH}
     elif com_setting["Button"] == "PressMinus":
-        GPIO.output(button_pin_array[2][var_button_plus], GPIO.HIGH)
-        GPIO.output(button_pin_array[1][var_button_option], GPIO.HIGH)
-        GPIO.output(button_pin_array[0][var_button_minus], GPIO.LOW)
-        # time.sleep(0.4)
-        # GPIO.output(button_pin_array[2][var_button_plus], GPIO.HIGH)
-        # GPIO.output(button_pin_array[1][var_button_option], GPIO.HIGH)
-        # GPIO.output(button_pin_array[0][var_button_minus], GPIO.HIGH)
-        # time.sleep(0.4)
-    elif com_setting["Button"] == "ReleaseMinus":
-        # GPIO.output(button_pin_array[2][var_button_plus], GPIO.HIGH)
-        # GPIO.output(button_pin_array[1][var_button_option], GPIO.HIGH)
-        # GPIO.output(button_pin_array[0][var_button_minus], GPIO.LOW)
-        # time.sleep(1)
-        GPIO.output(button_pin_array[2][var_button_plus], GPIO.HIGH)
-        GPIO.output(button_pin_array[1][var_button_option], GPIO.HIGH)
-        GPIO.output(button_pin_array[0][var_button_minus], GPIO.HIGH)
-        # time.sleep(0.4)
+        return {var_button_plus: PIN_HIGH, var_button_option: PIN_HIGH, var_button_minus: PIN_LOW}
     elif com_setting["Button"] == "PressOption":
-        GPIO.output(button_pin_array[2][var_button_plus], GPIO.HIGH)
-        GPIO.output(button_pin_array[1][var_button_option], GPIO.LOW)
-        GPIO.output(button_pin_array[0][var_button_minus], GPIO.HIGH)
-        # time.sleep(0.4)
-        # GPIO.output(button_pin_array[2][var_button_plus], GPIO.HIGH)
-        # GPIO.output(button_pin_array[1][var_button_option], GPIO.HIGH)
-        # GPIO.output(button_pin_array[0][var_button_minus], GPIO.HIGH)
-        # time.sleep(0.4)
-    elif com_setting["Button"] == "ReleaseOption":
-        # GPIO.output(button_pin_array[2][var_button_plus], GPIO.HIGH)
-        # GPIO.output(button_pin_array[1][var_button_option], GPIO.LOW)
-        # GPIO.output(button_pin_array[0][var_button_minus], GPIO.HIGH)
-        # time.sleep(1)
-        GPIO.output(button_pin_array[2][var_button_plus], GPIO.HIGH)
-        GPIO.output(button_pin_array[1][var_button_option], GPIO.HIGH)
-        GPIO.output(button_pin_array[0][var_button_minus], GPIO.HIGH)
-        # time.sleep(0.4)
+        return {var_button_plus: PIN_HIGH, var_button_option: PIN_LOW, var_button_minus: PIN_HIGH}
     else:
-        GPIO.output(button_pin_array[2][var_button_plus], GPIO.HIGH)
-        GPIO.output(button_pin_array[1][var_button_option], GPIO.HIGH)
-        GPIO.output(button_pin_array[0][var_button_minus], GPIO.HIGH)
-        time.sleep(0.4)
+        return button_termination_levels()
+
+
+def status_gear_levels():
+    # gear follows com_setting["Gear"] as gear generation runs after status
+    levels = status_signal_levels()
+    levels.update(gear_signal_levels())
+    return levels
+
+
+def desired_signal_levels():
+    # levels of every signal pin driven by a signal generation start
+    levels = status_gear_levels()
+    levels.update(beam_signal_levels())
+    levels.update(turn_signal_lamp_levels())
+    levels.update(hazard_signal_levels())
+    return levels
+
+
+def gear_termination_levels():
+    return {var_low_gear: PIN_LOW, var_medium_gear: PIN_LOW, var_high_gear: PIN_LOW}
+
+
+def status_termination_levels():
+    levels = {var_parking: PIN_LOW, var_backward_gear: PIN_LOW}
+    levels.update(gear_termination_levels())
+    return levels
+
+
+def beam_termination_levels():
+    return {var_low_beam: PIN_LOW, var_high_beam: PIN_LOW}
+
+
+def turn_signal_lamp_termination_levels():
+    return {var_turn_right: PIN_LOW, var_turn_left: PIN_LOW}
+
+
+def hazard_termination_levels():
+    return {var_dangerous: PIN_LOW}
+
+
+def button_termination_levels():
+    return {var_button_plus: PIN_HIGH, var_button_option: PIN_HIGH, var_button_minus: PIN_HIGH}
+
+
+def build_speed_duty_lut(valid_max_speed):
+    # duty cycle of every speed from 0 up to the first one that saturates
+    # at 100%, faster speeds map to 100% as well
+    speed_duty_lut = []
+    duty_cycle = 0.0
+    speed = 0
+    while duty_cycle < 100.0:
+        duty_cycle = min(float(speed * (50.0 - 4.67) / valid_max_speed + 4.67), 100.0)
+        speed_duty_lut.append(duty_cycle)
+        speed += 1
+    return speed_duty_lut
+
+
+def init_speed_duty_luts():
+    global g_speed_duty_luts
+
+    g_speed_duty_luts = {}
+    for i in range(len(rated_voltage_options)):
+        g_speed_duty_luts[rated_voltage_options[i]] = build_speed_duty_lut(rated_voltage_max_speed[i])
+    select_speed_duty_lut(com_setting["RatedVoltage"])
+
+
+def select_speed_duty_lut(rated_voltage):
+    global g_valid_max_speed
+    global g_speed_duty_lut
+
+    g_valid_max_speed = rated_voltage_max_speed[rated_voltage_options.index(rated_voltage)]
+    g_speed_duty_lut = g_speed_duty_luts[rated_voltage]
+    app_log.debug("max valid speed: %d", g_valid_max_speed)
+
+
+def record_speed_duty(duty_cycle):
+    global g_speed_duty
+
+    g_speed_duty = duty_cycle
+    g_state_versions.bump("Duty", var_speed)
+
+
+def speed_duty_cycle(speed):
+    if speed < len(g_speed_duty_lut):
+        return g_speed_duty_lut[speed]
+    return 100.0
+
+
+def speed_pwm_channel():
+    global g_pwm
+    global g_pwm_frequency
+
+    # the speed PWM is created once and restarted after a stop, RPi.GPIO
+    # allows only one PWM object per pin
+    if g_pwm is None:
+        g_pwm = speed_pwm(g_pwm_period)
+        g_pwm_frequency = g_pwm_period
+    return g_pwm
+
+
+def gpio_speed_generation():
+    app_log.debug("gpio_speed_generation")
+    global g_pwm_frequency
+
+    # start the speed PWM, or bring a running one to g_pwm_period and the
+    # current speed in place
+    pwm = speed_pwm_channel()
+    duty_cycle = speed_duty_cycle(com_setting["Speed"])
+    app_log.debug("duty_cycle: %s", duty_cycle)
+    if g_pwm_frequency != g_pwm_period:
+        pwm.ChangeFrequency(g_pwm_period)
+        g_pwm_frequency = g_pwm_period
+    if g_speed_duty is None and not cancel_deferred_output("speed_stop"):
+        pwm.start(duty_cycle)
+        record_speed_duty(duty_cycle)
+        time.sleep(0.001)
+    elif g_speed_duty != duty_cycle:
+        pwm.ChangeDutyCycle(duty_cycle)
+        record_speed_duty(duty_cycle)
+
+
+def gpio_speed_update():
+    global g_lock
+    global g_pwm
+
+    # hand the new duty cycle to the running PWM without waiting for it to
+    # take effect, the PWM switches over on its next period by itself
+    g_lock.acquire()
+    try:
+        # g_pwm outlives a stop, a stopped PWM is left for the next start
+        if com_setting["Signal"] == "Start" and com_setting["Mode"] == "GPIO" and g_speed_duty is not None:
+            duty_cycle = speed_duty_cycle(com_setting["Speed"])
+            app_log.debug("duty_cycle: %s", duty_cycle)
+            g_pwm.ChangeDutyCycle(duty_cycle)
+            record_speed_duty(duty_cycle)
+    finally:
+        g_lock.release()
+
+
+def gpio_status_generation():
+    app_log.debug("gpio_status_generation")
+    gpio_write_levels(status_signal_levels())
+
+
+def gpio_gear_generation():
+    app_log.debug("gpio_gear_generation")
+    gpio_write_levels(gear_signal_levels())
+
+
+def gpio_beam_generation():
+    app_log.debug("gpio_beam_generation")
+    gpio_write_levels(beam_signal_levels())
+
+
+def gpio_write_periodic_levels(channel, levels):
+    global g_lock
+
+    # while a signal period is set the pins that are on blink on the given
+    # periodic channel, the other pins are driven steady
+    g_lock.acquire()
+    try:
+        if com_setting["Signal"] == "Start" and com_setting["Mode"] == "GPIO" and com_setting["SignalPeriod"] > 0:
+            blinking_pins = [pin for pin, level in levels.items() if level == PIN_HIGH]
+        else:
+            blinking_pins = []
+        if len(blinking_pins) > 0:
+            gpio_write_levels(dict([(pin, level) for pin, level in levels.items() if pin not in blinking_pins]))
+            g_periodic_signals.set_channel(channel, blinking_pins, com_setting["SignalPeriod"])
+        else:
+            g_periodic_signals.clear_channel(channel)
+            gpio_write_levels(levels)
+    finally:
+        g_lock.release()
+
+
+def gpio_turn_signal_lamp_generation():
+    app_log.debug("gpio_turn_signal_lamp_generation")
+    gpio_write_periodic_levels("turn_signal_lamp", turn_signal_lamp_levels())
+
+
+def gpio_hazard_generation():
+    app_log.debug("gpio_hazard_generation")
+    gpio_write_periodic_levels("hazard", hazard_signal_levels())
+
+
+def defer_output(name, delay, function):
+    # run function under g_lock after delay, unless cancelled before
+    def run():
+        g_lock.acquire()
+        try:
+            if g_deferred_outputs.get(name) is timer:
+                del g_deferred_outputs[name]
+                function()
+        finally:
+            g_lock.release()
+
+    g_lock.acquire()
+    try:
+        cancel_deferred_output(name)
+        timer = threading.Timer(delay, run)
+        timer.daemon = True
+        g_deferred_outputs[name] = timer
+        timer.start()
+    finally:
+        g_lock.release()
+
+
+def cancel_deferred_output(name):
+    # return True when a pending change was cancelled
+    g_lock.acquire()
+    try:
+        timer = g_deferred_outputs.pop(name, None)
+        if timer is None:
+            return False
+        timer.cancel()
+        return True
+    finally:
+        g_lock.release()
+
+
+def gpio_button_signal_generation():
+    global g_button_release_until
+
+    app_log.debug("gpio_button_signal_generation")
+    g_lock.acquire()
+    try:
+        cancel_deferred_output("button")
+        if com_setting["Button"] == "None":
+            gpio_write_levels(button_termination_levels())
+            g_button_release_until = monotonic() + g_button_release_hold
+        elif monotonic() < g_button_release_until:
+            # the press follows once the release was held long enough
+            defer_output("button", g_button_release_until - monotonic(),
+                         lambda: gpio_write_levels(button_signal_levels()))
+        else:
+            gpio_write_levels(button_signal_levels())
+    finally:
+        g_lock.release()
 
 
 def gpio_speed_signal_termination():
@@ -283,565 +888,1077 @@ def gpio_speed_signal_termination():
     global g_pwm_period
 
     app_log.debug("gpio_speed_signal_termination")
+    if g_speed_duty is None:
+        return
+    # the PWM runs two more periods at 5% before it stops
     g_pwm.ChangeDutyCycle(5.0)
-    time.sleep(2 / g_pwm_period)
-    g_pwm.stop()
+    record_speed_duty(None)
+    defer_output("speed_stop", 2.0 / g_pwm_period, g_pwm.stop)
 
 
 def gpio_status_signal_termination():
     app_log.debug("gpio_status_signal_termination")
-    GPIO.output(get_value_in_dict_from_list(var_parking), GPIO.LOW)
-    GPIO.output(get_value_in_dict_from_list(var_backward_gear), GPIO.LOW)
-    GPIO.output(get_value_in_dict_from_list(var_low_gear), GPIO.LOW)
-    GPIO.output(get_value_in_dict_from_list(var_medium_gear), GPIO.LOW)
-    GPIO.output(get_value_in_dict_from_list(var_high_gear), GPIO.LOW)
+    gpio_write_levels(status_termination_levels())
 
 
 def gpio_gear_signal_termination():
     app_log.debug("gpio_gear_signal_termination")
-    GPIO.output(get_value_in_dict_from_list(var_low_gear), GPIO.LOW)
-    GPIO.output(get_value_in_dict_from_list(var_medium_gear), GPIO.LOW)
-    GPIO.output(get_value_in_dict_from_list(var_high_gear), GPIO.LOW)
+    gpio_write_levels(gear_termination_levels())
 
 
 def gpio_beam_signal_termination():
     app_log.debug("gpio_beam_signal_termination")
-    GPIO.output(get_value_in_dict_from_list(var_low_beam), GPIO.LOW)
-    GPIO.output(get_value_in_dict_from_list(var_high_beam), GPIO.LOW)
+    gpio_write_levels(beam_termination_levels())
 
 
 def gpio_turn_signal_lamp_termination():
     app_log.debug("gpio_turn_signal_lamp_termination")
-    GPIO.output(get_value_in_dict_from_list(var_turn_right), GPIO.LOW)
-    GPIO.output(get_value_in_dict_from_list(var_turn_left), GPIO.LOW)
+    gpio_write_levels(turn_signal_lamp_termination_levels())
+
+
+def gpio_hazard_termination():
+    app_log.debug("gpio_hazard_termination")
+    gpio_write_levels(hazard_termination_levels())
 
 
 def gpio_button_signal_termination():
     app_log.debug("gpio_button_signal_termination")
-    GPIO.output(button_pin_array[2][var_button_plus], GPIO.HIGH)
-    GPIO.output(button_pin_array[1][var_button_option], GPIO.HIGH)
-    GPIO.output(button_pin_array[0][var_button_minus], GPIO.HIGH)
-    # time.sleep(0.4)
+    gpio_write_levels(button_termination_levels())
+
+
+def one_wire_frame(settings):
+    status_flags = 0
+    for bit, (command, value) in enumerate(one_wire_status_flags):
+        if settings[command] == value:
+            status_flags |= 1 << bit
+    speed = min(settings["Speed"], 0xFFFF)
+    frame = [one_wire_customer_code, one_wire_model_code, status_flags, speed >> 8, speed & 0xFF,
+             min(settings["Volt"], 0xFF)] + [0] * one_wire_reserved_bytes
+    checksum = 0
+    for byte in frame:
+        checksum ^= byte
+    return bytearray(frame + [checksum])
+
+
+def one_wire_waveform(frame):
+    # (edges, frame length). edges are (offset from the frame start, level),
+    # phases of the same level are merged into one
+    phases = [(PIN_LOW, one_wire_sync)]
+    for byte in frame:
+        for i in range(7, -1, -1):
+            high, low = one_wire_bit_timing[(byte >> i) & 1]
+            phases.append((PIN_HIGH, high))
+            phases.append((PIN_LOW, low))
+    edges = []
+    offset = 0.0
+    for level, duration in phases:
+        if len(edges) == 0 or edges[-1][1] != level:
+            edges.append((offset, level))
+        offset += duration
+    return edges, offset
+
+
+class OneWireTransmitter(object):
+    # sends the current frame over and over from its own thread. the edge
+    # timing of a frame is computed once when its fields change, and every
+    # edge is due at its offset from the frame start so the timing does not
+    # drift. a new frame is picked up at the next frame boundary.
+
+    def __init__(self):
+        self.frames = 0
+        self._fields = None
+        self._waveform = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pin_num = None
+        self._level = None
+
+    def update(self, settings):
+        # return True when the frame was rebuilt
+        fields = tuple([settings[command] for command in one_wire_fields])
+        if fields == self._fields:
+            return False
+        waveform = one_wire_waveform(one_wire_frame(settings))
+        with self._lock:
+            self._fields = fields
+            self._waveform = waveform
+        return True
+
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._pin_num = g_pin_table[var_one_wire]
+        self._level = g_pin_levels[self._pin_num]
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        # called with g_lock held, the pin table learns the level the
+        # transmitter left the pin at
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        g_pin_levels[self._pin_num] = self._level
+
+    def _run(self):
+        # the pin belongs to the transmitter while it runs, its edges are
+        # written directly rather than through gpio_write_levels
+        begin = monotonic()
+        while True:
+            with self._lock:
+                edges, length = self._waveform
+            for offset, edge_level in edges:
+                if self._stop.wait(max(0.0, begin + offset - monotonic())):
+                    return
+                if edge_level != self._level:
+                    g_gpio.output(self._pin_num, edge_level)
+                    self._level = edge_level
+            self.frames += 1
+            # after a stall the next frame starts now instead of rushing
+            # through the edges it missed
+            begin = max(begin + length, monotonic())
 
 
 def one_wire_signal_generation(status, app_log):
     global g_lock
-    global g_pwm
 
-    app_log.debug(status + " generating signal on 1wire")
-    app_log.info("1wire not implemented")
+    app_log.debug("%s generating signal on 1wire", status)
     g_lock.acquire()
-    g_lock.release()
+    try:
+        if status == "Start":
+            g_one_wire.update(com_setting)
+            g_one_wire.start()
+        elif status == "Stop":
+            g_one_wire.stop()
+            gpio_write_levels({var_one_wire: PIN_LOW})
+        else:
+            app_log.error("error signal value")
+    finally:
+        g_lock.release()
+
+
+def one_wire_update():
+    # rebuild the frame being sent when one of its fields changed
+    if com_setting["Signal"] == "Start" and com_setting["Mode"] == "1wire" and g_one_wire.update(com_setting):
+        app_log.debug("1wire frame rebuilt")
 
 
 def gpio_signal_generation(status, app_log):
     global g_lock
 
-    app_log.debug(status + " generating signal on gpio")
+    app_log.debug("%s generating signal on gpio", status)
 
     g_lock.acquire()
-    if status == "Start":
-        app_log.debug(com_setting)
-        # speed generation
-        gpio_speed_generation()
-        # voltage generation
-        # volt not implemented
-        # status generation
-        gpio_status_generation()
-        # gear generation
-        gpio_gear_generation()
-        # beam generation
-        gpio_beam_generation()
-        # turn signal lamp generation
-        gpio_turn_signal_lamp_generation()
-    elif status == "Stop":
-        # speed set to 0
-        gpio_speed_signal_termination()
-        # status set default
+    try:
+        if status == "Start":
+            app_log.debug(com_setting)
+            # speed generation
+            gpio_speed_generation()
+            # voltage generation
+            # volt not implemented
+            # status generation
+            gpio_status_generation()
+            # gear generation
+            gpio_gear_generation()
+            # beam generation
+            gpio_beam_generation()
+            # turn signal lamp generation
+            gpio_turn_signal_lamp_generation()
+            # hazard generation
+            gpio_hazard_generation()
+        elif status == "Stop":
+            # stop blinking before the pins are driven to their defaults
+            g_periodic_signals.clear()
+            # speed set to 0
+            gpio_speed_signal_termination()
+            # status set default
+            gpio_status_signal_termination()
+            # gear set default
+            gpio_gear_signal_termination()
+            # beam set default
+            gpio_beam_signal_termination()
+            # turn signal lamp set default
+            gpio_turn_signal_lamp_termination()
+            # hazard set default
+            gpio_hazard_termination()
+        else:
+            app_log.error("error signal value")
+    finally:
+        g_lock.release()
+
+
+def signal_reconfiguration(app_log):
+    global g_lock
+
+    # bring the outputs to what a start in the current mode drives, writing
+    # only the pins that differ and keeping the speed PWM and the blinking
+    # phase. only a mode change stops the outputs of the other mode.
+    app_log.debug("reconfiguring signal generation for %s", com_setting["Mode"])
+    g_lock.acquire()
+    try:
+        if com_setting["Mode"] == "GPIO":
+            if g_one_wire.running():
+                one_wire_signal_generation("Stop", app_log)
+            gpio_speed_generation()
+            gpio_status_generation()
+            gpio_gear_generation()
+            gpio_beam_generation()
+            gpio_turn_signal_lamp_generation()
+            gpio_hazard_generation()
+        else:
+            if g_speed_duty is not None:
+                gpio_signal_generation("Stop", app_log)
+            one_wire_signal_generation("Start", app_log)
+    finally:
+        g_lock.release()
+
+
+def signal_termination(app_log):
+    global g_lock
+
+    # stop the outputs of both modes
+    g_lock.acquire()
+    try:
+        if g_one_wire.running():
+            one_wire_signal_generation("Stop", app_log)
+        if com_setting["Mode"] == "GPIO" or g_speed_duty is not None:
+            gpio_signal_generation("Stop", app_log)
+    finally:
+        g_lock.release()
+
+
+def signal_command_generation(command, app_log):
+    if command in ["Mode", "RatedVoltage"]:
+        # reconfigure running signal generation in place
+        if com_setting["Signal"] == "Start":
+            signal_reconfiguration(app_log)
+    elif command == "Speed":
+        app_log.debug("com_setting[%s]: %s", command, com_setting[command])
+        gpio_speed_update()
+        one_wire_update()
+    elif command == "SignalPeriod":
+        app_log.debug("com_setting[%s]: %s", command, com_setting[command])
+        if com_setting["Signal"] == "Start":
+            gpio_turn_signal_lamp_generation()
+            gpio_hazard_generation()
+    elif command == "Signal":
+        app_log.debug("com_setting[%s]: %s", command, com_setting[command])
+        # Mode may have changed in the same batch, so whatever the other
+        # mode still drives is stopped as well
+        if com_setting[command] == "Start":
+            signal_reconfiguration(app_log)
+        else:
+            signal_termination(app_log)
+    elif command == "CruiserMode":
+        app_log.debug("com_setting[%s]: %s", command, com_setting[command])
+        one_wire_update()
+    elif command == "Volt":
+        app_log.debug("com_setting[%s]: %s", command, com_setting[command])
+        one_wire_update()
+    elif command == "Status":
+        app_log.debug("com_setting[%s]: %s", command, com_setting[command])
+        if com_setting["Signal"] == "Start":
+            gpio_status_generation()
+    elif command == "Gear":
+        app_log.debug("com_setting[%s]: %s", command, com_setting[command])
+        if com_setting["Signal"] == "Start":
+            gpio_gear_generation()
+    elif command == "Beam":
+        app_log.debug("com_setting[%s]: %s", command, com_setting[command])
+        if com_setting["Signal"] == "Start":
+            gpio_beam_generation()
+    elif command == "TurnSignalLamp":
+        app_log.debug("com_setting[%s]: %s", command, com_setting[command])
+        if com_setting["Signal"] == "Start":
+            gpio_turn_signal_lamp_generation()
+    elif command == "Hazard":
+        app_log.debug("com_setting[%s]: %s", command, com_setting[command])
+        if com_setting["Signal"] == "Start":
+            gpio_hazard_generation()
+    elif command in ["HallMalfunction", "GripShiftMalfunction", "ControllerMalfunction", "OpenPhaseMalfunction"]:
+        app_log.debug("com_setting[%s]: %s", command, com_setting[command])
+        one_wire_update()
+    elif command == "Button":
+        app_log.debug("com_setting[%s]: %s", command, com_setting[command])
+        gpio_button_signal_generation()
+    else:
+        app_log.error("unrecognized command:%s", command)
+
+
+def signal_batch_generation(commands, app_log):
+    app_log.debug("commands: %s", commands)
+    # a (re)start of signal generation already drives speed, status, gear,
+    # beam and turn signal lamp from com_setting, so those commands are only
+    # applied on their own when no restart is part of the batch
+    restart_commands = [command for command in commands if command in ["Signal", "Mode", "RatedVoltage"]]
+    covered_commands = ["Speed", "Status", "Gear", "Beam", "TurnSignalLamp", "Hazard", "SignalPeriod"]
+    if len(restart_commands) > 0:
+        if "Signal" in restart_commands:
+            signal_command_generation("Signal", app_log)
+        else:
+            signal_command_generation(restart_commands[0], app_log)
+    for command in commands:
+        if command in restart_commands:
+            continue
+        if len(restart_commands) > 0 and command in covered_commands:
+            continue
+        if command in ["Status", "Gear"] and "Status" in commands:
+            # status drives the gear pins as well, both go in one write
+            # ending at the same levels as the two commands one at a time
+            if command == "Status" and com_setting["Signal"] == "Start":
+                gpio_write_levels(status_gear_levels())
+            continue
+        signal_command_generation(command, app_log)
+
+
+class LatencyHistogram(object):
+    # fixed number of power of two buckets of microseconds, bucket i counts
+    # latencies in [2^(i-1), 2^i) us
+
+    bucket_count = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.bucket_count
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        index = min(int(seconds * 1000000).bit_length(), self.bucket_count - 1)
+        self.buckets[index] += 1
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        # upper bound in seconds of the bucket holding the percentile
+        threshold = self.count * percent / 100.0
+        total = 0
+        for index in range(self.bucket_count):
+            total += self.buckets[index]
+            if total >= threshold and total > 0:
+                return min((1 << index) / 1000000.0, self.max)
+        return self.max
+
+
+class CommandTrace(object):
+    # monotonic timestamps of one command line through latency_stages
+
+    def __init__(self, received=None):
+        self.timestamps = {"received": received if received is not None else monotonic()}
+
+    def mark(self, stage):
+        self.timestamps[stage] = monotonic()
+
+
+class CommandStats(object):
+    # per command type end-to-end latency plus per stage latency histograms
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.commands = collections.OrderedDict()
+            self.stages = collections.OrderedDict()
+            for i in range(1, len(latency_stages)):
+                self.stages[latency_stages[i - 1] + "-" + latency_stages[i]] = LatencyHistogram()
+            self.failed = 0
+
+    def record(self, command, trace):
+        timestamps = trace.timestamps
+        with self._lock:
+            if "acked" not in timestamps:
+                self.failed += 1
+                return
+            if command not in self.commands:
+                self.commands[command] = LatencyHistogram()
+            self.commands[command].add(timestamps["acked"] - timestamps["received"])
+            for i in range(1, len(latency_stages)):
+                start = timestamps.get(latency_stages[i - 1])
+                end = timestamps.get(latency_stages[i])
+                if start is not None and end is not None:
+                    self.stages[latency_stages[i - 1] + "-" + latency_stages[i]].add(end - start)
+
+    def report(self):
+        lines = []
+        with self._lock:
+            for name, histograms in [("Command", self.commands), ("Stage", self.stages)]:
+                for key, histogram in histograms.items():
+                    if histogram.count == 0:
+                        continue
+                    lines.append("Stats %s=%s Count=%d P50=%.3fms P90=%.3fms P99=%.3fms Max=%.3fms" % (
+                        name, key, histogram.count, histogram.percentile(50) * 1000,
+                        histogram.percentile(90) * 1000, histogram.percentile(99) * 1000, histogram.max * 1000))
+            lines.append("Stats Failed=%d" % self.failed)
+        return lines
+
+
+class StateVersions(object):
+    # every change of a setting, a pin level or the speed duty cycle takes
+    # the next state version, so a host can ask for what changed since the
+    # version it last saw
+
+    def __init__(self):
+        self.version = 0
+        self._versions = {}
+        self._condition = threading.Condition()
+
+    def bump(self, kind, name):
+        with self._condition:
+            self.version += 1
+            self._versions[(kind, name)] = self.version
+            self._condition.notify_all()
+
+    def changed_since(self, since):
+        # (kind, name) of everything changed after since
+        with self._condition:
+            return set([key for key, version in self._versions.items() if version > since])
+
+    def wait_newer(self, version):
+        # block until the state version is past version, return the new one
+        with self._condition:
+            while self.version <= version:
+                self._condition.wait()
+            return self.version
+
+    def restore(self, version):
+        # versions continue after the restored one
+        with self._condition:
+            self.version = max(self.version, version)
+
+
+class StatePersister(object):
+    # writes the applied state to a file from a background thread after
+    # every change. the file is written beside the old one and renamed over
+    # it, so a crash leaves either the old or the new state on disk.
+
+    def __init__(self, path):
+        self.path = path
+        self._last = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        version = -1
+        while True:
+            version = g_state_versions.wait_newer(version)
+            state = applied_state()
+            # blinking pins change the version without changing the state
+            # that is worth saving
+            if state != self._last:
+                try:
+                    self._write(state, version)
+                    self._last = state
+                except Exception as e:
+                    app_log.error("state file %s not written: %s", self.path, e)
+            time.sleep(g_state_save_interval)
+
+    def _write(self, state, version):
+        saved = dict(state)
+        saved["version"] = version
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as fd:
+            json.dump(saved, fd, sort_keys=True)
+            fd.flush()
+            os.fsync(fd.fileno())
+        replace_file(temp_path, self.path)
+        # the rename is only durable once the directory entry is on disk
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class CommandHandle(object):
+    # completion handle of a command submitted to signal_generation_service,
+    # done once the command's GPIO effects are applied or it failed
+
+    def __init__(self, command, trace=None):
+        self.command = command
+        self.trace = trace
+        self.error = None
+        self.merged = []
+        # command: (previous, new) value of the settings it changes
+        self.settings = {}
+        self._done = threading.Event()
+
+    def mark(self, stage):
+        if self.trace is not None:
+            self.trace.mark(stage)
+        for handle in self.merged:
+            handle.mark(stage)
+
+    def merge(self, handle):
+        # a newer update of the same command, done together with this one
+        self.merged.append(handle)
+
+    def set_done(self, error=None):
+        # the first result stays, a worker replaced by the watchdog may
+        # still finish the command it hung in
+        if self._done.is_set():
+            return
+        self.error = error
+        if self.trace is not None:
+            self.trace.mark("applied")
+        self._done.set()
+        for handle in self.merged:
+            handle.set_done(error)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        # return True when the command was applied without error
+        if not self._done.wait(timeout):
+            return False
+        return self.error is None
+
+
+class CommandQueue(object):
+    # FIFO of CommandHandle for signal_generation_service. an update of a
+    # last-writer-wins command is merged into the one still waiting in the
+    # queue, the worker reads com_setting when applying it so the newest
+    # value wins. every other command keeps its own place and order.
+
+    def __init__(self, coalescing_commands):
+        self._handles = collections.deque()
+        self._pending = {}
+        self._condition = threading.Condition()
+        self.high_water = 0
+        self.coalesced = {}
+        for command in coalescing_commands:
+            self.coalesced[command] = 0
+
+    def put(self, handle):
+        with self._condition:
+            command = handle.command
+            if not isinstance(command, list) and command in self.coalesced:
+                if command in self._pending:
+                    self._pending[command].merge(handle)
+                    self.coalesced[command] += 1
+                    return
+                self._pending[command] = handle
+            self._handles.append(handle)
+            self.high_water = max(self.high_water, len(self._handles))
+            self._condition.notify()
+
+    def get(self):
+        with self._condition:
+            while len(self._handles) == 0:
+                self._condition.wait()
+            return self._pop()
+
+    def get_nowait(self):
+        with self._condition:
+            if len(self._handles) == 0:
+                raise queue.Empty
+            return self._pop()
+
+    def _pop(self):
+        handle = self._handles.popleft()
+        if not isinstance(handle.command, list) and self._pending.get(handle.command) is handle:
+            del self._pending[handle.command]
+        return handle
+
+    def reset_stats(self):
+        with self._condition:
+            self.high_water = len(self._handles)
+            for command in self.coalesced:
+                self.coalesced[command] = 0
+
+    def task_done(self):
+        pass
+
+    def qsize(self):
+        return len(self._handles)
+
+    def empty(self):
+        return len(self._handles) == 0
+
+
+def submit_command(command):
+    global g_queue
+
+    handle = CommandHandle(command, getattr(g_command_context, "trace", None))
+    changes = getattr(g_command_context, "settings", None)
+    if changes:
+        for name, previous in changes.items():
+            handle.settings[name] = (previous, com_setting[name])
+        g_command_context.settings = None
+    handle.mark("enqueued")
+    if g_threads_error_flag:
+        fail_command(handle, RuntimeError("signal generation service stopped"))
+        return handle
+    if g_supervisor is not None and not g_supervisor.available:
+        fail_command(handle, RuntimeError("signal generation service hung"))
+        return handle
+    g_queue.put(handle)
+    app_log.debug("queue length is :%d", g_queue.qsize())
+    return handle
+
+
+def enqueue_command(command):
+    # submit the command and wait until signal generation applied it. inside
+    # deferred_setting the handle is collected instead of waited for.
+    deferred = getattr(g_command_context, "deferred", None)
+    if deferred is not None:
+        deferred.append(submit_command(command))
+        return True
+    handle = submit_command(command)
+    if not wait_command(handle):
+        app_log.error("command: %s failed: %s", command, handle.error)
+        return False
+    return True
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+def wait_command(handle):
+    # wait for the handle, failing it when it is not applied within
+    # g_command_timeout. the watchdog only sees the command once a worker
+    # took it, this also covers the time spent in the queue.
+    if handle.wait(g_command_timeout):
+        return True
+    if not handle.done():
+        fail_command(handle, CommandTimeout("command: %s timed out" % (handle.command,)))
+    return handle.wait(0)
+
+
+def fail_command(handle, error):
+    # fail the handle and roll back the settings it changed, unless a newer
+    # command changed them since. the worker reads com_setting when it
+    # applies a command, so a command failed before it ran is never applied.
+    if handle.done():
+        return
+    handle.set_done(error)
+    for name, (previous, new) in handle.settings.items():
+        for merged in handle.merged:
+            if name in merged.settings:
+                new = merged.settings[name][1]
+        if com_setting[name] == new and previous != new:
+            app_log.warning("rolling back %s=%s to %s", name, new, previous)
+            com_setting[name] = previous
+            g_state_versions.bump("Setting", name)
+            if name == "RatedVoltage":
+                select_speed_duty_lut(previous)
+
+
+def fail_pending_commands(error):
+    # fail every command still queued, nothing will run them
+    while True:
+        try:
+            handle = g_queue.get_nowait()
+        except queue.Empty:
+            return
+        fail_command(handle, error)
+        g_queue.task_done()
+
+
+def drive_safe_state(app_log):
+    # outputs to their defaults as Signal=Stop drives them, com_setting is
+    # kept so the worker can resume from it
+    app_log.warning("driving outputs to safe state")
+    g_lock.acquire()
+    try:
+        g_periodic_signals.clear()
+        g_one_wire.stop()
+        gpio_write_levels({var_one_wire: PIN_LOW})
+        if g_pwm is not None and g_speed_duty is not None:
+            gpio_speed_signal_termination()
         gpio_status_signal_termination()
-        # gear set default
         gpio_gear_signal_termination()
-        # beam set default
         gpio_beam_signal_termination()
-        # turn signal lamp set default
         gpio_turn_signal_lamp_termination()
-    else:
-        app_log.error("error signal value")
-    g_lock.release()
+        gpio_hazard_termination()
+        cancel_deferred_output("button")
+        gpio_button_signal_termination()
+    finally:
+        g_lock.release()
 
 
-def signal_generation_service(app_log):
-    global g_semaphore
-    global g_event
-    global g_queue
-    global g_threads_error_flag
-
+def signal_generation_service(app_log, supervisor, generation, recover):
     app_log.debug("signal_generation_service")
+    handle = None
     try:
-        while not g_threads_error_flag:
-            app_log.debug("waiting for event")
-            g_event.wait()
-            app_log.debug("event set")
-            command = g_queue.get()
+        if recover:
+            # a recovery counts as a command for the watchdog
+            supervisor.begin_command(generation, None)
+            drive_safe_state(app_log)
+            reapply_state(app_log)
+            supervisor.end_command(generation)
+        while supervisor.is_current(generation):
+            app_log.debug("waiting for command")
+            handle = g_queue.get()
+            if handle.done():
+                # failed while queued, its waiter timed out
+                g_queue.task_done()
+                handle = None
+                continue
+            supervisor.begin_command(generation, handle)
+            handle.mark("dequeued")
             app_log.debug("queue length is :%d", g_queue.qsize())
-            app_log.debug("command: %s", command)
-
-            if command == "Mode":
-                # restart signal generation when mode changed
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                if com_setting["Signal"] == "Start":
-                    if com_setting["Mode"] == "1wire":
-                        one_wire_signal_generation("Stop", app_log)
-                        one_wire_signal_generation("Start", app_log)
-                    else:
-                        gpio_signal_generation("Stop", app_log)
-                        gpio_signal_generation("Start", app_log)
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "RatedVoltage":
-                # restart signal generation when rated voltage changed
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                if com_setting["Signal"] == "Start":
-                    if com_setting["Mode"] == "1wire":
-                        one_wire_signal_generation("Stop", app_log)
-                        one_wire_signal_generation("Start", app_log)
-                    else:
-                        gpio_signal_generation("Stop", app_log)
-                        gpio_signal_generation("Start", app_log)
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "Speed":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                if com_setting["Signal"] == "Start":
-                    if com_setting["Mode"] == "GPIO":
-                        global g_pwm
-                        global g_pwm_period
-                        global g_valid_max_speed
-                        if g_pwm is not None:
-                            # duty_cycle = float(int(com_setting[command]) * (50.0 ) / (g_valid_max_speed) + 5.0)
-                            duty_cycle = float(int(com_setting["Speed"]) * (50.0 - 4.67) / g_valid_max_speed + 4.67)
-                            app_log.debug("duty_cycle: %s", duty_cycle)
-                            if duty_cycle > 100.0:
-                                duty_cycle = 100.0
-                                app_log.debug("duty_cycle: %s", duty_cycle)
-                            g_pwm.ChangeDutyCycle(duty_cycle)
-                            time.sleep(2 / g_pwm_period)
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "SignalPeriod":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "Signal":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                if com_setting["Mode"] == "1wire":
-                    one_wire_signal_generation(com_setting[command], app_log)
-                else:
-                    gpio_signal_generation(com_setting[command], app_log)
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "CruiserMode":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                one_wire_signal_generation(com_setting[command], app_log)
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "Volt":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                app_log.info("volt not implemented")
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "Status":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                if com_setting["Signal"] == "Start":
-                    gpio_status_generation()
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "Gear":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                if com_setting["Signal"] == "Start":
-                    gpio_gear_generation()
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "Beam":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                if com_setting["Signal"] == "Start":
-                    gpio_beam_generation()
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "TurnSignalLamp":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                if com_setting["Signal"] == "Start":
-                    gpio_turn_signal_lamp_generation()
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "HallMalfunction":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                app_log.info("hall malfunction not implemented")
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "GripShiftMalfunction":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                app_log.info("grip shift malfunction not implemented")
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "ControllerMalfunction":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                app_log.info("controller malfunction not implemented")
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "OpenPhaseMalfunction":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                app_log.info("open phase malfunction not implemented")
-                g_semaphore.release()
-                app_log.debug("semaphore released")
-            elif command == "Button":
-                app_log.debug("waiting for semaphore")
-                g_semaphore.acquire()
-                app_log.debug("semaphore acquired")
-                app_log.debug("com_setting[" + command + "]: %s", str(com_setting[command]))
-                gpio_button_signal_generation()
-                g_semaphore.release()
-                app_log.debug("semaphore released")
+            app_log.debug("command: %s", handle.command)
+
+            if isinstance(handle.command, list):
+                signal_batch_generation(handle.command, app_log)
             else:
-                app_log.error("unrecognized command:%s", command)
+                signal_command_generation(handle.command, app_log)
+            supervisor.end_command(generation)
+            handle.set_done()
+            handle = None
 
             g_queue.task_done()
             app_log.debug("queue length is :%d", g_queue.qsize())
-            g_event.clear()
-            app_log.debug("event cleared")
     except Exception as e:
-        g_threads_error_flag = True
-        raise e
+        app_log.exception("signal generation worker %d failed", generation)
+        if handle is not None:
+            fail_command(handle, e)
+
+
+class SignalGenerationSupervisor(object):
+    # runs signal_generation_service in a worker thread. a worker that dies,
+    # or hangs in a command past g_command_timeout, is replaced after a
+    # backoff, and the new worker drives the outputs to a safe state and
+    # resumes from com_setting before it takes the next command. a replaced
+    # worker stops at its next command. a hung worker still holding g_lock is
+    # waited for rather than piled up with new ones, commands fail at once
+    # meanwhile.
+
+    def __init__(self, app_log):
+        self.restarts = 0
+        self.watchdog_trips = 0
+        self.available = True
+        self._app_log = app_log
+        self._generation = 0
+        self._command = None
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def is_current(self, generation):
+        return generation == self._generation
+
+    def begin_command(self, generation, handle):
+        with self._lock:
+            if generation == self._generation:
+                self._command = (handle, monotonic())
+
+    def end_command(self, generation):
+        with self._lock:
+            if generation == self._generation:
+                self._command = None
+
+    def _overrun(self):
+        # (True, handle) when the current command is past its deadline
+        with self._lock:
+            if self._command is not None and monotonic() - self._command[1] > g_command_timeout:
+                return True, self._command[0]
+            return False, None
+
+    def _run(self):
+        recover = False
+        failures = 0
+        while True:
+            with self._lock:
+                self._generation += 1
+                self._command = None
+                generation = self._generation
+            started = monotonic()
+            worker = threading.Thread(target=signal_generation_service,
+                                      args=(self._app_log, self, generation, recover))
+            worker.daemon = True
+            worker.start()
+            while True:
+                worker.join(g_command_timeout / 4.0)
+                if not worker.is_alive():
+                    self._app_log.error("signal generation worker %d died", generation)
+                    break
+                overrun, handle = self._overrun()
+                if overrun:
+                    self.watchdog_trips += 1
+                    self._app_log.error("signal generation worker %d hung for more than %.1f s",
+                                        generation, g_command_timeout)
+                    if handle is not None:
+                        fail_command(handle, CommandTimeout("command: %s timed out" % (handle.command,)))
+                    break
+            with self._lock:
+                # the old worker takes no further command
+                self._generation += 1
+            self.restarts += 1
+            # a worker that ran well for a while starts the backoff over
+            if monotonic() - started > g_restart_backoff_max:
+                failures = 0
+            failures += 1
+            backoff = min(g_restart_backoff_max, g_restart_backoff * 2 ** (failures - 1))
+            self._app_log.warning("restarting signal generation in %.1f s, restart %d", backoff, self.restarts)
+            time.sleep(backoff)
+            if not g_lock.acquire(False):
+                # a new worker would block on g_lock too
+                self._app_log.error("hung signal generation worker %d still holds the GPIO lock, waiting",
+                                    generation)
+                self.available = False
+                error = RuntimeError("signal generation service hung")
+                while not g_lock.acquire(False):
+                    fail_pending_commands(error)
+                    time.sleep(g_command_timeout / 4.0)
+                fail_pending_commands(error)
+                self.available = True
+            g_lock.release()
+            recover = True
+
+
+def store_setting(command, value):
+    # the previous value goes with the next submitted command, which rolls
+    # it back when it fails
+    changes = getattr(g_command_context, "settings", None)
+    if changes is None:
+        changes = g_command_context.settings = {}
+    if command not in changes:
+        changes[command] = com_setting[command]
+    com_setting[command] = value
+    g_state_versions.bump("Setting", command)
 
 
 def mode_setting(command, value):
-    global g_queue
-    global g_semaphore
-
-    app_log.debug("command, value:" + command + ", " + str(value))
+    app_log.debug("command, value: %s, %s", command, value)
 
     if value in mode_options:
         if com_setting[command] != value:
-            com_setting[command] = value
-            g_queue.put(command)
-            app_log.debug("queue length is :%d", g_queue.qsize())
-            g_event.set()
-            app_log.debug("set event")
-            app_log.debug("waiting for semaphore")
-            g_semaphore.acquire()
-            app_log.debug("semaphore acquired")
-            g_semaphore.release()
-            app_log.debug("semaphore released")
+            store_setting(command, value)
+            return enqueue_command(command)
         else:
-            app_log.warning("same " + command + " value:" + value + ". doing nothing")
+            app_log.warning("same %s value: %s. doing nothing", command, value)
         return True
     else:
-        app_log.error(command + " value: " + str(value) + " not valid")
+        app_log.error("%s value: %s not valid", command, value)
         app_log.warning("set mode to GPIO as default")
-        com_setting["Mode"] = "GPIO"
+        store_setting("Mode", "GPIO")
         return False
 
 
 def gpio_signal_setting(command, value):
-    global g_queue
-    global g_semaphore
-
-    app_log.debug("command, value:" + command + ", " + str(value))
+    app_log.debug("command, value: %s, %s", command, value)
     if command == "Status" and value in status_options:
         if com_setting[command] != value:
-            com_setting[command] = value
-            g_queue.put(command)
-            app_log.debug("queue length is :%d", g_queue.qsize())
-            g_event.set()
-            app_log.debug("set event")
-            app_log.debug("waiting for semaphore")
-            g_semaphore.acquire()
-            app_log.debug("semaphore acquired")
-            g_semaphore.release()
-            app_log.debug("semaphore released")
+            store_setting(command, value)
+            return enqueue_command(command)
         else:
-            app_log.warning("same " + command + " value:" + value + ". doing nothing")
+            app_log.warning("same %s value: %s. doing nothing", command, value)
         return True
     elif command == "Gear" and value in gear_options:
         if com_setting[command] != value:
-            com_setting[command] = value
-            g_queue.put(command)
-            app_log.debug("queue length is :%d", g_queue.qsize())
-            g_event.set()
-            app_log.debug("set event")
-            app_log.debug("waiting for semaphore")
-            g_semaphore.acquire()
-            app_log.debug("semaphore acquired")
-            g_semaphore.release()
-            app_log.debug("semaphore released")
+            store_setting(command, value)
+            return enqueue_command(command)
         else:
-            app_log.warning("same " + command + " value:" + value + ". doing nothing")
+            app_log.warning("same %s value: %s. doing nothing", command, value)
         return True
     elif command == "Beam" and value in beam_options:
         if com_setting[command] != value:
-            com_setting[command] = value
-            g_queue.put(command)
-            app_log.debug("queue length is :%d", g_queue.qsize())
-            g_event.set()
-            app_log.debug("set event")
-            app_log.debug("waiting for semaphore")
-            g_semaphore.acquire()
-            app_log.debug("semaphore acquired")
-            g_semaphore.release()
-            app_log.debug("semaphore released")
+            store_setting(command, value)
+            return enqueue_command(command)
         else:
-            app_log.warning("same " + command + " value:" + value + ". doing nothing")
+            app_log.warning("same %s value: %s. doing nothing", command, value)
         return True
     elif command == "TurnSignalLamp" and value in turn_signal_lamp_options:
         if com_setting[command] != value:
-            com_setting[command] = value
-            g_queue.put(command)
-            app_log.debug("queue length is :%d", g_queue.qsize())
-            g_event.set()
-            app_log.debug("set event")
-            app_log.debug("waiting for semaphore")
-            g_semaphore.acquire()
-            app_log.debug("semaphore acquired")
-            g_semaphore.release()
-            app_log.debug("semaphore released")
+            store_setting(command, value)
+            return enqueue_command(command)
+        else:
+            app_log.warning("same %s value: %s. doing nothing", command, value)
+        return True
+    elif command == "Hazard" and value in hazard_options:
+        if com_setting[command] != value:
+            store_setting(command, value)
+            return enqueue_command(command)
         else:
-            app_log.warning("same " + command + " value:" + value + ". doing nothing")
+            app_log.warning("same %s value: %s. doing nothing", command, value)
         return True
     else:
-        app_log.error(command + " value: " + str(value) + " not valid")
+        app_log.error("%s value: %s not valid", command, value)
         return False
 
 
 def speed_setting(command, value):
     global g_max_speed
     global g_min_speed
-    global g_queue
-    global g_semaphore
 
-    app_log.debug("command, value:" + command + ", " + str(value))
+    app_log.debug("command, value: %s, %s", command, value)
     if value.isdigit() and g_min_speed <= int(value) <= g_max_speed:
         if com_setting[command] != int(value):
-            com_setting[command] = int(value)
-            g_queue.put(command)
-            app_log.debug("queue length is :%d", g_queue.qsize())
-            g_event.set()
-            app_log.debug("set event")
-            app_log.debug("waiting for semaphore")
-            g_semaphore.acquire()
-            app_log.debug("semaphore acquired")
-            g_semaphore.release()
-            app_log.debug("semaphore released")
+            store_setting(command, int(value))
+            return enqueue_command(command)
         else:
-            app_log.warning("same " + command + " value:" + value + ". doing nothing")
+            app_log.warning("same %s value: %s. doing nothing", command, value)
         return True
     else:
-        app_log.error(command + " value: " + str(value) + " not valid")
+        app_log.error("%s value: %s not valid", command, value)
         return False
 
 
 def button_setting(command, value):
-    global g_queue
-    global g_semaphore
-
-    app_log.debug("command, value:" + command + ", " + str(value))
+    app_log.debug("command, value: %s, %s", command, value)
     if value in button_options:
-        com_setting[command] = value
-        g_queue.put(command)
-        app_log.debug("queue length is :%d", g_queue.qsize())
-        g_event.set()
-        app_log.debug("set event")
-        app_log.debug("waiting for semaphore")
-        g_semaphore.acquire()
-        app_log.debug("semaphore acquired")
-        g_semaphore.release()
-        app_log.debug("semaphore released")
-        return True
+        store_setting(command, value)
+        return enqueue_command(command)
     else:
-        app_log.error(command + " value: " + str(value) + " not valid")
+        app_log.error("%s value: %s not valid", command, value)
         return False
 
 
 def one_wire_setting(command, value):
-    global g_queue
-    global g_semaphore
-
-    app_log.debug("command, value:" + command + ", " + str(value))
-    app_log.info("1wire not implemented")
+    app_log.debug("command, value: %s, %s", command, value)
     if value in cruiser_mode_options:
         if com_setting[command] != value:
-            com_setting[command] = value
-            g_queue.put(command)
-            app_log.debug("queue length is :%d", g_queue.qsize())
-            g_event.set()
-            app_log.debug("set event")
-            app_log.debug("waiting for semaphore")
-            g_semaphore.acquire()
-            app_log.debug("semaphore acquired")
-            g_semaphore.release()
-            app_log.debug("semaphore released")
+            store_setting(command, value)
+            return enqueue_command(command)
         else:
-            app_log.warning("same " + command + " value:" + value + ". doing nothing")
+            app_log.warning("same %s value: %s. doing nothing", command, value)
         return True
     else:
-        app_log.error(command + " value: " + str(value) + " not valid")
+        app_log.error("%s value: %s not valid", command, value)
         return False
 
 
 def rated_voltage_setting(command, value):
-    global g_valid_max_speed
-    global g_queue
-    global g_semaphore
-
-    app_log.debug("command, value:" + command + ", " + str(value))
-    app_log.info("rated_voltage not implemented")
+    app_log.debug("command, value: %s, %s", command, value)
     if value.isdigit() and int(value) in rated_voltage_options:
         if com_setting[command] != int(value):
-            for i in range(len(rated_voltage_options)):
-                app_log.debug("rate_voltage:" + str(rated_voltage_options[i]) + " i:" + str(i))
-                if int(value) == rated_voltage_options[i]:
-                    g_valid_max_speed = rated_voltage_max_speed[i]
-                    app_log.debug("max valid speed:" + str(g_valid_max_speed))
-            g_queue.put(command)
-            g_event.set()
-            app_log.debug("set event")
-            app_log.debug("queue length is :%d", g_queue.qsize())
-            app_log.debug("waiting for semaphore")
-            g_semaphore.acquire()
-            app_log.debug("semaphore acquired")
-            g_semaphore.release()
-            app_log.debug("semaphore released")
+            store_setting(command, int(value))
+            select_speed_duty_lut(com_setting[command])
+            return enqueue_command(command)
         else:
-            app_log.warning("same " + command + " value:" + value + ". doing nothing")
+            app_log.warning("same %s value: %s. doing nothing", command, value)
         return True
     else:
-        app_log.error(command + " value: " + str(value) + " not valid")
+        app_log.error("%s value: %s not valid", command, value)
         return False
 
 
 def voltage_setting(command, value):
     global g_max_voltage
     global g_min_voltage
-    global g_queue
-    global g_semaphore
-
-    app_log.debug("command, value:" + command + ", " + str(value))
-    app_log.info("voltage not implemented")
 
+    app_log.debug("command, value: %s, %s", command, value)
     if value.isdigit() and g_min_voltage <= int(value) <= g_max_voltage:
         if com_setting[command] != int(value):
-            com_setting[command] = int(value)
-            g_queue.put(command)
-            g_event.set()
-            app_log.debug("set event")
-            app_log.debug("queue length is :%d", g_queue.qsize())
-            app_log.debug("waiting for semaphore")
-            g_semaphore.acquire()
-            app_log.debug("semaphore acquired")
-            g_semaphore.release()
-            app_log.debug("semaphore released")
+            store_setting(command, int(value))
+            return enqueue_command(command)
         else:
-            app_log.warning("same " + command + " value:" + value + ". doing nothing")
+            app_log.warning("same %s value: %s. doing nothing", command, value)
         return True
     else:
-        app_log.error(command + " value: " + str(value) + " not valid")
+        app_log.error("%s value: %s not valid", command, value)
         return False
 
 
 def signal_period_setting(command, value):
     global g_max_signal_period
     global g_min_signal_period
-    global g_queue
-    global g_semaphore
 
-    app_log.debug("command, value:" + command + ", " + str(value))
+    app_log.debug("command, value: %s, %s", command, value)
     if value.isdigit() and g_min_signal_period <= int(value) <= g_max_signal_period:
         if com_setting[command] != int(value):
-            com_setting[command] = int(value)
-            g_queue.put(command)
-            app_log.debug("queue length is :%d", g_queue.qsize())
-            g_event.set()
-            app_log.debug("set event")
-            app_log.debug("waiting for semaphore")
-            g_semaphore.acquire()
-            app_log.debug("semaphore acquired")
-            g_semaphore.release()
-            app_log.debug("semaphore released")
+            store_setting(command, int(value))
+            return enqueue_command(command)
         else:
-            app_log.warning("same " + command + " value:" + value + ". doing nothing")
+            app_log.warning("same %s value: %s. doing nothing", command, value)
         return True
     else:
-        app_log.error(command + " value: " + str(value) + " not valid")
+        app_log.error("%s value: %s not valid", command, value)
         return False
 
 
 def signal_generation(command, value):
-    global g_queue
-    global g_semaphore
-
-    app_log.debug("command, value:" + command + ", " + str(value))
+    app_log.debug("command, value: %s, %s", command, value)
     if value in signal_options:
         if com_setting[command] != value:
-            com_setting[command] = value
-            g_queue.put(command)
-            app_log.debug("queue length is :%d", g_queue.qsize())
-            g_event.set()
-            app_log.debug("set event")
-            app_log.debug("waiting for semaphore")
-            g_semaphore.acquire()
-            app_log.debug("semaphore acquired")
-            g_semaphore.release()
-            app_log.debug("semaphore released")
+            store_setting(command, value)
+            return enqueue_command(command)
         else:
-            app_log.warning("same " + command + " value:" + value + ". doing nothing")
+            app_log.warning("same %s value: %s. doing nothing", command, value)
         return True
     else:
-        app_log.error(command + " value: " + str(value) + " not valid")
+        app_log.error("%s value: %s not valid", command, value)
         return False
 
 
+def validate_setting(command, value):
+    # return the value as it would be stored in com_setting, or None when the
+    # value is not valid for the command
+    if command == "Mode" and value in mode_options:
+        return value
+    elif command == "Speed" and value.isdigit() and g_min_speed <= int(value) <= g_max_speed:
+        return int(value)
+    elif command in ["CruiserMode", "HallMalfunction", "GripShiftMalfunction", "ControllerMalfunction",
+                     "OpenPhaseMalfunction"] and value in cruiser_mode_options:
+        return value
+    elif command == "RatedVoltage" and value.isdigit() and int(value) in rated_voltage_options:
+        return int(value)
+    elif command == "Volt" and value.isdigit() and g_min_voltage <= int(value) <= g_max_voltage:
+        return int(value)
+    elif command == "Status" and value in status_options:
+        return value
+    elif command == "Gear" and value in gear_options:
+        return value
+    elif command == "Beam" and value in beam_options:
+        return value
+    elif command == "TurnSignalLamp" and value in turn_signal_lamp_options:
+        return value
+    elif command == "Button" and value in button_options:
+        return value
+    elif command == "SignalPeriod" and value.isdigit() and g_min_signal_period <= int(value) <= g_max_signal_period:
+        return int(value)
+    elif command == "Signal" and value in signal_options:
+        return value
+    elif command == "Hazard" and value in hazard_options:
+        return value
+    else:
+        return None
+
+
+def batch_setting(settings):
+    app_log.debug("settings: %s", settings)
+    # validate the whole batch before touching com_setting
+    values = {}
+    for command, value in settings:
+        if com_com.get(command) is None or command in values:
+            app_log.error("command: %s not valid in batch", command)
+            return False
+        valid_value = validate_setting(command, value)
+        if valid_value is None:
+            app_log.error("%s value: %s not valid", command, value)
+            return False
+        values[command] = valid_value
+
+    commands = []
+    for command, value in settings:
+        if command == "Button" or com_setting[command] != values[command]:
+            store_setting(command, values[command])
+            commands.append(command)
+    if "RatedVoltage" in commands:
+        select_speed_duty_lut(com_setting["RatedVoltage"])
+
+    if len(commands) > 0:
+        return enqueue_command(commands)
+    else:
+        app_log.warning("same values in batch. doing nothing")
+    return True
+
+
 signal_function = {
     "Mode": mode_setting,
     "Speed": speed_setting,
@@ -859,10 +1976,26 @@ signal_function = {
     "Button": button_setting,
     "SignalPeriod": signal_period_setting,
     "Signal": signal_generation,
+    "Hazard": gpio_signal_setting,
 }
 
 
-def init_logging():
+class RecordQueueHandler(logging.Handler):
+    # puts the record itself on the queue so the listener thread formats it,
+    # QueueHandler would format it in the logging thread. the arguments are
+    # formatted late, a logged dict shows what it holds by then.
+
+    def __init__(self, log_queue):
+        logging.Handler.__init__(self)
+        self.queue = log_queue
+
+    def emit(self, record):
+        self.queue.put_nowait(record)
+
+
+def init_logging(log_level=logging.DEBUG, async_writer=False):
+    global g_log_listener
+
     log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s(%(lineno)d) %(message)s')
     log_file = 'ebike_control_board.log'
 
@@ -878,13 +2011,35 @@ def init_logging():
     console_handler.setFormatter(log_formatter)
 
     app_log = logging.getLogger('root')
-    app_log.setLevel(logging.DEBUG)
-
-    app_log.addHandler(file_handler)
+    app_log.setLevel(log_level)
+
+    if async_writer:
+        # callers only put records on a queue, a background thread formats
+        # them and does the blocking writes to the SD card. QueueListener
+        # needs python 3.2.
+        from logging.handlers import QueueListener
+        log_queue = queue.Queue()
+        g_log_listener = QueueListener(log_queue, file_handler)
+        g_log_listener.start()
+        import atexit
+        atexit.register(g_log_listener.stop)
+        app_log.addHandler(RecordQueueHandler(log_queue))
+    else:
+        app_log.addHandler(file_handler)
     # app_log.addHandler(console_handler)
     return app_log
 
 
+def log_level_setting(value):
+    if value in log_level_options:
+        app_log.setLevel(logging.getLevelName(value))
+        app_log.warning("log level set to %s", value)
+        return True
+    else:
+        app_log.error("log level: %s not valid", value)
+        return False
+
+
 def init_global_variables():
     global g_pwm
     global g_pwm_period
@@ -897,8 +2052,10 @@ def init_global_variables():
     global g_threads
     global g_queue
     global g_lock
-    global g_semaphore
-    global g_event
+    global g_stats
+    global g_state_versions
+    global g_periodic_signals
+    global g_one_wire
 
     for command, value in com_com.items():
         com_setting[command] = com_com[command]
@@ -911,58 +2068,140 @@ def init_global_variables():
     g_max_voltage = 100
     g_min_voltage = 0
     g_threads = []
-    import sys
-    if sys.version_info >= (3, 0):
-        g_queue = queue.Queue()
-    else:
-        g_queue = Queue.Queue()
+    g_queue = CommandQueue(coalescing_commands)
+    g_stats = CommandStats()
+    g_state_versions = StateVersions()
 
-    g_lock = threading.Lock()
-    g_event = threading.Event()
-    g_semaphore = threading.Semaphore()
+    # re-entrant, signal generation holds it while driving groups of pins
+    g_lock = threading.RLock()
+    g_periodic_signals = PeriodicSignalScheduler()
+    g_one_wire = OneWireTransmitter()
+    init_speed_duty_luts()
 
 
 def init_signal_generation_service(app_log):
     global g_threads
-    global g_queue
-    global g_lock
     global g_threads_error_flag
+    global g_supervisor
 
     g_threads_error_flag = False
 
-    t = threading.Thread(target=signal_generation_service, args=(app_log,))
-    t.setDaemon(True)
-    g_threads.append(t)
+    g_supervisor = SignalGenerationSupervisor(app_log)
+    g_threads.append(g_supervisor.thread)
 
-    t.start()
 
+def init_gpio_backend(app_log, backend_name):
+    global g_gpio
 
-def init_gpio_pins(app_log):
-    global g_lock
-    g_lock.acquire()
-    GPIO.setmode(GPIO.BOARD)
+    app_log.info("gpio backend: %s", backend_name)
+    g_gpio = gpio_backends[backend_name]()
+
+
+def init_speed_pwm(app_log, root, chip, channel):
+    global g_speed_pwm_sysfs
+
+    # use the hardware PWM only when the chip is there, RPi.GPIO's software
+    # PWM stays the fallback. pin 7 has no hardware PWM, the speed input of
+    # the panel has to be wired to the PWM pin of the channel instead, see
+    # hardware_pwm_pins.
+    chip_path = os.path.join(root, "pwmchip%d" % chip)
+    if not os.path.isdir(chip_path):
+        app_log.error("%s not found, speed signal uses gpio pwm", chip_path)
+        return
+    pwm_pin = hardware_pwm_pins.get(channel)
+    button_pins = [pin_num for pin_pair in button_pin_array for pin_num in pin_pair.values()]
+    if pwm_pin is None or pwm_pin in button_pins:
+        app_log.error("pwm channel %d has no free pin, speed signal uses gpio pwm", channel)
+        return
     for pin_pair in signal_pin_array:
         for pin, pin_num in pin_pair.items():
-            GPIO.setup(pin_num, GPIO.OUT)
-    for pin_pair in button_pin_array:
-        for pin, pin_num in pin_pair.items():
-            GPIO.setup(pin_num, GPIO.OUT)
-    for pin_pair in speed_pin_array:
-        for pin, pin_num in pin_pair.items():
-            GPIO.setup(pin_num, GPIO.OUT)
-    for pin_pair in one_wire_pin_array:
-        for pin, pin_num in pin_pair.items():
-            GPIO.setup(pin_num, GPIO.OUT)
-    g_lock.release()
+            if pin_num == pwm_pin:
+                app_log.warning("pin %d drives the speed signal instead of %s", pwm_pin, pin.strip())
+    app_log.info("speed signal on hardware pwm %s channel %d, pin %d", chip_path, channel, pwm_pin)
+    g_speed_pwm_sysfs = (root, chip, channel)
+    g_reserved_pins.add(pwm_pin)
+
 
+def init_gpio_pins(app_log, initial_levels=None):
+    global g_lock
 
-def init_serial(app_log):
+    # initial_levels are restored pin levels the pins start out with
+    if initial_levels is None:
+        initial_levels = {}
+    g_lock.acquire()
+    try:
+        g_gpio.setmode()
+        # a pin reserved for the hardware PWM is not touched
+        init_pin_table()
+        for pin, pin_num in g_pin_table.items():
+            g_gpio.setup_output(pin_num, initial_levels.get(pin))
+        for pin, level in initial_levels.items():
+            g_pin_levels[g_pin_table[pin]] = level
+    finally:
+        g_lock.release()
+
+
+def load_state(app_log, path):
+    # return the saved state, or None when there is none to restore
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except (IOError, OSError) as e:
+        app_log.warning("state file %s not loaded: %s", path, e)
+    except ValueError as e:
+        app_log.error("state file %s not valid: %s", path, e)
+    return None
+
+
+def restore_state(app_log, state):
+    # take over the saved settings, return the saved pin levels for
+    # init_gpio_pins. values that are not valid any more keep their default.
+    for command, value in state.get("settings", {}).items():
+        if com_com.get(command) is None:
+            continue
+        valid_value = validate_setting(command, str(value))
+        if valid_value is None:
+            app_log.error("saved %s value: %s not valid", command, value)
+            continue
+        com_setting[command] = valid_value
+    select_speed_duty_lut(com_setting["RatedVoltage"])
+    g_state_versions.restore(state.get("version", 0))
+    # the pin table is needed before init_gpio_pins builds it
+    init_pin_table()
+    pin_names = dict([(pin.strip(), pin) for pin in g_pin_table])
+    initial_levels = {}
+    for pin, level in state.get("pins", {}).items():
+        if pin in pin_names and level in [PIN_HIGH, PIN_LOW]:
+            initial_levels[pin_names[pin]] = level
+    app_log.info("restored state version %d", g_state_versions.version)
+    return initial_levels
+
+
+def reapply_state(app_log):
+    # the pins already start at their restored levels, restarting signal
+    # generation brings back the speed PWM and the blinking pins. nothing
+    # else is written as the levels do not differ. after drive_safe_state
+    # the held buttons are pressed again, they do not depend on Signal.
+    if com_setting["Signal"] == "Start":
+        signal_command_generation("Signal", app_log)
+    gpio_write_levels(button_signal_levels())
+
+
+def init_state_persister(app_log, path):
+    global g_state_persister
+
+    app_log.info("state file: %s", path)
+    g_state_persister = StatePersister(path)
+
+
+def init_serial(app_log, port_name):
     try:
-        ser_port = serial.Serial(port='/dev/ttyUSB0',
+        ser_port = serial.Serial(port=port_name,
                                  baudrate=115200,
                                  parity=serial.PARITY_NONE,
                                  stopbits=serial.STOPBITS_ONE,
-                                 bytesize=serial.EIGHTBITS)
+                                 bytesize=serial.EIGHTBITS,
+                                 timeout=g_serial_read_timeout)
     except serial.SerialException:
         app_log.error("serial exception detected")
         raise serial.SerialException
@@ -975,6 +2214,38 @@ def init_serial(app_log):
             return None
 
 
+def startup_phase(app_log, phase, started):
+    # log how long a startup phase took, return the start of the next one
+    now = monotonic()
+    app_log.info("startup %s: %.1f ms", phase, (now - started) * 1000)
+    return now
+
+
+def prewarm(app_log, features):
+    # import heavy modules in the background so their first command does
+    # not stall
+    for feature in features:
+        started = monotonic()
+        try:
+            if feature == "numpy":
+                get_numpy()
+            elif feature == "cv2":
+                import cv2
+            elif feature == "camera":
+                get_camera(app_log)
+        except Exception as e:
+            app_log.error("prewarm %s failed: %s", feature, e)
+        else:
+            startup_phase(app_log, "prewarm " + feature, started)
+
+
+def init_prewarm(app_log, features):
+    if len(features) > 0:
+        t = threading.Thread(target=prewarm, args=(app_log, features))
+        t.daemon = True
+        t.start()
+
+
 def get_ip_address(ifname):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.connect(('8.8.8.8', 80))
@@ -984,77 +2255,477 @@ def get_ip_address(ifname):
     return ip[0]
 
 
-def check_signal_gpio_pins(ser_port):
-    # set each gpio to high, hold on 5 seconds, then set to low and wait
-    # 3 seconds.
+def signal_check_drive(ser_port, check, group, pin, level, hold):
+    # drive one pin, verify it reads back at that level, report it and hold
+    # it. return False when the check was aborted.
+    gpio_write_levels({pin: level})
+    passed = g_gpio.input(g_pin_table[pin]) == level
+    with check["lock"]:
+        check["checked"] += 1
+        if not passed:
+            check["failed"] += 1
+    serial_write_line(ser_port, "SignalCheck Group=%s Pin=%s Num=%d Level=%s Result=%s" % (
+        group, pin.strip(), g_pin_table[pin], "High" if level == PIN_HIGH else "Low", "OK" if passed else "Fail"))
+    return not g_signal_check_abort.wait(hold)
+
+
+def check_signal_gpio_pins(ser_port, check):
+    # set each gpio to high and hold it, then set it low and wait, one pin at
+    # a time so every signal can be seen on the panel on its own
     for pin_pair in signal_pin_array:
         for pin, pin_num in pin_pair.items():
-            ser_port.write(("pin:" + pin + " " + str(pin_num) + " start to set high").encode('utf-8'))
-            GPIO.output(pin_num, GPIO.HIGH)
-            time.sleep(3)
-            ser_port.write(("pin:" + pin + " " + str(pin_num) + " start to set low").encode('utf-8'))
-            GPIO.output(pin_num, GPIO.LOW)
-            time.sleep(1)
-
-
-def speed_sweeping(ser_port):
-    pwm = GPIO.PWM(speed_pin_array[0][var_speed], 61)
-    ser_port.write(("start to speed sweeping from minimum to maximum" + "\r\n").encode('utf-8'))
-    pwm.start(0.0)
-    time.sleep(2 / 61)
-    pwm.ChangeDutyCycle(45.0)
-    time.sleep(2 / 61)
-    step = (50.0 - 5.0) / 75
-    for i in np.arange(5.0, 50.0, step):
-        ser_port.write(("duty cycle:" + str(i) + " - speed:" + str((i - 5.0) / step) + "\r\n").encode('utf-8'))
-        pwm.ChangeDutyCycle(i)
-        time.sleep(0.1)
-
-    ser_port.write(("start to speed sweeping from maximum to minimum" + "\r\n").encode('utf-8'))
-    for i in np.arange(50.0, 5.0, -step):
-        ser_port.write(("duty cycle:" + str(i) + " - speed:" + str((i - 5.0) / step) + "\r\n").encode('utf-8'))
-        pwm.ChangeDutyCycle(i)
-        time.sleep(0.1)
-
-    ser_port.write(("duty cycle:" + str(5.0) + " - speed:" + str((5.0 - 5.0) / step) + "\r\n").encode('utf-8'))
-    pwm.ChangeDutyCycle(5.0)
-    time.sleep(2 / 61)
-    pwm.stop()
-
-
-def button_check(ser_port):
-    ser_port.write("start to button_check".encode('utf-8'))
-    ser_port.write("long press option button".encode('utf-8'))
-    for pin, pin_num in button_pin_array[1].items():
-        GPIO.output(pin_num, GPIO.LOW)
-        time.sleep(1)
-        GPIO.output(pin_num, GPIO.HIGH)
-        time.sleep(1)
-    ser_port.write("press + button".encode('utf-8'))
-    for pin, pin_num in button_pin_array[2].items():
-        GPIO.output(pin_num, GPIO.LOW)
-        time.sleep(0.6)
-        GPIO.output(pin_num, GPIO.HIGH)
-        time.sleep(1)
-    ser_port.write("press - button".encode('utf-8'))
-    for pin, pin_num in button_pin_array[0].items():
-        GPIO.output(pin_num, GPIO.LOW)
-        time.sleep(0.6)
-        GPIO.output(pin_num, GPIO.HIGH)
-        time.sleep(1)
-    ser_port.write("press option button".encode('utf-8'))
-    for pin, pin_num in button_pin_array[1].items():
-        GPIO.output(pin_num, GPIO.LOW)
-        time.sleep(0.6)
-        GPIO.output(pin_num, GPIO.HIGH)
-        time.sleep(1)
+            if pin not in g_pin_table:
+                continue
+            if not signal_check_drive(ser_port, check, "pins", pin, PIN_HIGH, check["hold"]):
+                gpio_write_levels({pin: PIN_LOW})
+                return
+            if not signal_check_drive(ser_port, check, "pins", pin, PIN_LOW, check["gap"]):
+                return
 
 
-def launch_daemon(ser_port, app_log):
-    ser_port.flushInput()
-    ser_port.flushOutput()
+def get_numpy():
+    global g_numpy
+
+    # numpy is only needed by the sweeps and takes long to import on the pi
+    if g_numpy is None:
+        import numpy
+        g_numpy = numpy
+    return g_numpy
+
+
+def build_speed_sweep(start, end, steps):
+    # speeds of every sweep step and their duty cycles, interpolated once
+    # from the speed calibration of the active rated voltage
+    np = get_numpy()
+    speeds = np.linspace(start, end, steps)
+    return speeds, np.interp(speeds, np.arange(len(g_speed_duty_lut)), g_speed_duty_lut)
+
+
+def set_sweep_duty(duty_cycle):
+    global g_lock
+
+    # a Signal command may have stopped the PWM since the last step
+    g_lock.acquire()
+    try:
+        pwm = speed_pwm_channel()
+        if g_speed_duty is None and not cancel_deferred_output("speed_stop"):
+            pwm.start(duty_cycle)
+        else:
+            pwm.ChangeDutyCycle(duty_cycle)
+        record_speed_duty(duty_cycle)
+    finally:
+        g_lock.release()
+
+
+def run_speed_sweep(ser_port, speeds, duty_cycles, dwell, report_every, abort_event, prefix):
+    # step through the precomputed duty cycles, step i is due i * dwell
+    # after the start so late steps do not push the later ones back.
+    # return False when the sweep was aborted.
+    set_sweep_duty(duty_cycles[0])
+
+    serial_write_line(ser_port, "%sSweep Start=%.1f End=%.1f Steps=%d Dwell=%.0fms" % (
+        prefix, speeds[0], speeds[-1], len(speeds), dwell * 1000))
+    completed = True
+    begin = monotonic()
+    for i in range(len(duty_cycles)):
+        if abort_event.wait(max(0.0, begin + i * dwell - monotonic())):
+            completed = False
+            break
+        set_sweep_duty(duty_cycles[i])
+        if i % report_every == 0 or i == len(duty_cycles) - 1:
+            serial_write_line(ser_port, "%sSweep Step=%d/%d Speed=%.1f Duty=%.2f Late=%.3fms" % (
+                prefix, i + 1, len(duty_cycles), speeds[i], duty_cycles[i], (monotonic() - begin - i * dwell) * 1000))
+    if completed:
+        abort_event.wait(dwell)
+
+    # a Signal command may have come in during the sweep, so the speed
+    # output is left as com_setting says now
+    g_lock.acquire()
     try:
-        in_buffer_bytes = ser_port.inWaiting()
+        if com_setting["Signal"] == "Start" and com_setting["Mode"] == "GPIO":
+            gpio_speed_generation()
+        else:
+            gpio_speed_signal_termination()
+    finally:
+        g_lock.release()
+    return completed
+
+
+def speed_sweeping(ser_port, check):
+    # from standstill to the maximum valid speed and back
+    steps = g_valid_max_speed + 1
+    speeds, duty_cycles = build_speed_sweep(0, g_valid_max_speed, steps)
+    np = get_numpy()
+    speeds = np.concatenate((speeds, speeds[-2::-1]))
+    duty_cycles = np.concatenate((duty_cycles, duty_cycles[-2::-1]))
+    run_speed_sweep(ser_port, speeds, duty_cycles, check["sweep_dwell"], max(1, steps // 5),
+                    g_signal_check_abort, "SignalCheck Group=speed ")
+    with check["lock"]:
+        check["checked"] += 1
+
+
+def speed_job_running():
+    # SWEEP and the speed group of SIGNALCHECK both drive the speed PWM, only
+    # one of them runs at a time
+    for thread in [g_sweep_thread, g_signal_check_thread]:
+        if thread is not None and thread.is_alive():
+            return True
+    return False
+
+
+def parse_key_arguments(argument, defaults, name, app_log):
+    # <key>=<digits> arguments of a command, keys from defaults. return the
+    # given values, or None
+    values = {}
+    for item in argument.split():
+        if item.find('=') < 0 or item[:item.index('=')] not in defaults \
+                or not item[item.index('=') + 1:].isdigit():
+            app_log.error("%s argument: %s not valid", name, item)
+            return None
+        values[item[:item.index('=')]] = int(item[item.index('=') + 1:])
+    return values
+
+
+def sweep_start(ser_port, argument, app_log):
+    global g_sweep_thread
+    global g_sweep_port
+
+    # SWEEP [start=<speed>] [end=<speed>] [steps=<n>] [dwell=<ms>] [report=<n>]
+    if speed_job_running():
+        app_log.error("sweep or signal check already running")
+        return None
+    values = parse_key_arguments(argument, sweep_defaults, "sweep", app_log)
+    if values is None:
+        return None
+    sweep = dict(sweep_defaults)
+    sweep["end"] = g_valid_max_speed
+    sweep.update(values)
+    if sweep["steps"] < 2 or sweep["report"] < 1 or max(sweep["start"], sweep["end"]) > g_max_speed:
+        app_log.error("sweep: %s not valid", sweep)
+        return None
+    speeds, duty_cycles = build_speed_sweep(sweep["start"], sweep["end"], sweep["steps"])
+    app_log.info("sweep: %s", sweep)
+    g_sweep_abort.clear()
+    g_sweep_port = ser_port
+    g_sweep_thread = threading.Thread(target=run_sweep, args=(
+        ser_port, speeds, duty_cycles, sweep["dwell"] / 1000.0, sweep["report"]))
+    g_sweep_thread.daemon = True
+    return g_sweep_thread
+
+
+def run_sweep(ser_port, speeds, duty_cycles, dwell, report_every):
+    if run_speed_sweep(ser_port, speeds, duty_cycles, dwell, report_every, g_sweep_abort, ""):
+        serial_write_line(ser_port, "Sweep Done Result=OK")
+    else:
+        serial_write_line(ser_port, "Sweep Done Result=Aborted")
+
+
+def sweep_abort(ser_port):
+    if g_sweep_thread is None or not g_sweep_thread.is_alive() or g_sweep_port is not ser_port:
+        return False
+    g_sweep_abort.set()
+    g_sweep_thread.join()
+    return True
+
+
+def button_check(ser_port, check):
+    # buttons are pressed one at a time, the panel reads simultaneous
+    # presses as a different key
+    presses = [(var_button_option, check["long_press"]),
+               (var_button_plus, check["press"]),
+               (var_button_minus, check["press"]),
+               (var_button_option, check["press"])]
+    for pin, press in presses:
+        if not signal_check_drive(ser_port, check, "buttons", pin, PIN_LOW, press):
+            gpio_write_levels({pin: PIN_HIGH})
+            return
+        if not signal_check_drive(ser_port, check, "buttons", pin, PIN_HIGH, check["gap"]):
+            return
+
+
+def run_signal_check(ser_port, check, app_log):
+    app_log.info("signal check started: %s", check)
+    # the signal pins, the speed pin and the buttons are separate outputs,
+    # so the three groups run at the same time
+    g_periodic_signals.clear()
+    groups = []
+    for target in [check_signal_gpio_pins, speed_sweeping, button_check]:
+        t = threading.Thread(target=target, args=(ser_port, check))
+        t.daemon = True
+        t.start()
+        groups.append(t)
+    for t in groups:
+        t.join()
+
+    # put the outputs back to what signal generation is driving
+    if com_setting["Signal"] == "Start" and com_setting["Mode"] == "GPIO":
+        gpio_write_levels(desired_signal_levels())
+        gpio_turn_signal_lamp_generation()
+        gpio_hazard_generation()
+    gpio_write_levels(button_signal_levels())
+
+    if g_signal_check_abort.is_set():
+        result = "Aborted"
+    elif check["failed"] > 0:
+        result = "Fail"
+    else:
+        result = "Pass"
+    app_log.info("signal check finished: %s", result)
+    serial_write_line(ser_port, "SignalCheck Done Result=%s Checked=%d Failed=%d" % (
+        result, check["checked"], check["failed"]))
+
+
+def signal_check_start(ser_port, argument, app_log):
+    global g_signal_check_thread
+    global g_signal_check_port
+
+    # SIGNALCHECK [hold=<ms>] [gap=<ms>] [press=<ms>] [long_press=<ms>] [sweep_dwell=<ms>]
+    if speed_job_running():
+        app_log.error("sweep or signal check already running")
+        return None
+    values = parse_key_arguments(argument, signal_check_defaults, "signal check", app_log)
+    if values is None:
+        return None
+    check = dict(signal_check_defaults)
+    for key, value in values.items():
+        check[key] = value / 1000.0
+    check["checked"] = 0
+    check["failed"] = 0
+    check["lock"] = threading.Lock()
+    g_signal_check_abort.clear()
+    g_signal_check_port = ser_port
+    g_signal_check_thread = threading.Thread(target=run_signal_check, args=(ser_port, check, app_log))
+    g_signal_check_thread.daemon = True
+    return g_signal_check_thread
+
+
+def signal_check_abort(ser_port):
+    if g_signal_check_thread is None or not g_signal_check_thread.is_alive() \
+            or g_signal_check_port is not ser_port:
+        return False
+    g_signal_check_abort.set()
+    g_signal_check_thread.join()
+    return True
+
+
+def session_scenario(ser_port):
+    # timeline, player thread and abort event of the session's scenario
+    scenario = g_scenarios.get(ser_port)
+    if scenario is None:
+        scenario = {"steps": [], "thread": None, "abort": threading.Event()}
+        g_scenarios[ser_port] = scenario
+    return scenario
+
+
+def scenario_setting(ser_port, argument):
+    # SCENARIO CLEAR, or SCENARIO ADD <ms> <Command>=<Value>[;<Command>=<Value>]
+    app_log.debug("scenario: %s", argument)
+    scenario = session_scenario(ser_port)
+    steps = scenario["steps"]
+    if argument == "CLEAR":
+        if scenario["thread"] is not None and scenario["thread"].is_alive():
+            app_log.error("scenario running, can not clear it")
+            return False
+        scenario["steps"] = []
+        return True
+    items = argument.split(None, 2)
+    if len(items) != 3 or items[0] != "ADD" or not items[1].isdigit():
+        app_log.error("scenario: %s not valid", argument)
+        return False
+    if len(steps) >= g_max_scenario_steps:
+        app_log.error("scenario longer than %d steps", g_max_scenario_steps)
+        return False
+    settings = parse_batch_line(items[2])
+    if not settings:
+        app_log.error("scenario step: %s not valid", items[2])
+        return False
+    for command, value in settings:
+        if com_com.get(command) is None or validate_setting(command, value) is None:
+            app_log.error("%s value: %s not valid", command, value)
+            return False
+    # keep the timeline sorted, steps with the same time keep upload order
+    offset = int(items[1]) / 1000.0
+    index = len(steps)
+    while index > 0 and steps[index - 1][0] > offset:
+        index -= 1
+    steps.insert(index, (offset, settings))
+    return True
+
+
+def run_scenario(ser_port, steps, abort_event, app_log):
+    # every step is scheduled against the monotonic start time, so a late
+    # step does not delay the ones after it
+    app_log.info("scenario started, %d steps", len(steps))
+    start = monotonic()
+    max_error = 0.0
+    for index in range(len(steps)):
+        offset, settings = steps[index]
+        if abort_event.wait(max(0.0, start + offset - monotonic())):
+            app_log.info("scenario aborted at step %d", index)
+            serial_write_line(ser_port, "Scenario Aborted Step=%d" % index)
+            return
+        actual = monotonic() - start
+        if len(settings) == 1:
+            command, value = settings[0]
+            result = signal_function.get(command)(command, value)
+        else:
+            result = batch_setting(settings)
+        applied = monotonic() - start
+        max_error = max(max_error, abs(actual - offset))
+        serial_write_line(ser_port, "Scenario Step=%d Command=%s Planned=%.3fms Actual=%.3fms Error=%.3fms "
+                                    "Applied=%.3fms Result=%s" % (
+                              index, ";".join([command + "=" + value for command, value in settings]),
+                              offset * 1000, actual * 1000, (actual - offset) * 1000, applied * 1000,
+                              "OK" if result else "Fail"))
+    app_log.info("scenario finished")
+    serial_write_line(ser_port, "Scenario Done Steps=%d MaxError=%.3fms" % (len(steps), max_error * 1000))
+
+
+def scenario_run(ser_port, app_log):
+    scenario = session_scenario(ser_port)
+    if scenario["thread"] is not None and scenario["thread"].is_alive():
+        app_log.error("scenario already running")
+        return None
+    if len(scenario["steps"]) == 0:
+        app_log.error("scenario is empty")
+        return None
+    scenario["abort"].clear()
+    scenario["thread"] = threading.Thread(target=run_scenario, args=(
+        ser_port, list(scenario["steps"]), scenario["abort"], app_log))
+    scenario["thread"].daemon = True
+    return scenario["thread"]
+
+
+def scenario_abort(ser_port):
+    scenario = g_scenarios.get(ser_port)
+    if scenario is None or scenario["thread"] is None or not scenario["thread"].is_alive():
+        return False
+    scenario["abort"].set()
+    scenario["thread"].join()
+    return True
+
+
+class CameraPipeline(object):
+    # keeps the camera open and reads frames continuously from one thread,
+    # so the newest frame is ready when a snapshot is asked for and the
+    # driver's buffer never holds stale frames
+
+    def __init__(self, device):
+        import cv2
+        self._cv2 = cv2
+        self._capture = cv2.VideoCapture(device)
+        if not self._capture.isOpened():
+            raise IOError("camera %s can not be opened" % device)
+        self._frame = None
+        self._frame_ready = threading.Event()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            ret, frame = self._capture.read()
+            if not ret:
+                app_log.warning("camera frame read failed")
+                self._stop.wait(0.1)
+                continue
+            with self._lock:
+                self._frame = frame
+            self._frame_ready.set()
+
+    def latest_frame(self, timeout=2.0):
+        if not self._frame_ready.wait(timeout):
+            return None
+        with self._lock:
+            return self._frame
+
+    def encode_jpeg(self, frame, width, height, quality):
+        # resize and encode in memory, one of width/height 0 keeps the aspect
+        # ratio
+        frame_height, frame_width = frame.shape[:2]
+        if width > 0 or height > 0:
+            if width == 0:
+                width = int(round(frame_width * height / float(frame_height)))
+            if height == 0:
+                height = int(round(frame_height * width / float(frame_width)))
+            if (width, height) != (frame_width, frame_height):
+                frame = self._cv2.resize(frame, (width, height), interpolation=self._cv2.INTER_AREA)
+        ret, encoded = self._cv2.imencode('.jpg', frame, [int(self._cv2.IMWRITE_JPEG_QUALITY), quality])
+        if not ret:
+            return None
+        return encoded.tobytes()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._capture.release()
+
+
+def get_camera(app_log):
+    global g_camera
+
+    # the camera is opened on the first snapshot and stays open
+    with g_camera_lock:
+        if g_camera is None:
+            app_log.info("open camera %s", g_camera_device)
+            g_camera = CameraPipeline(g_camera_device)
+    return g_camera
+
+
+def take_snapshot(ser_port, argument, app_log):
+    # TAKESNAPSHOT [width=<px>] [height=<px>] [quality=<1-100>] [chunk=<bytes>]
+    # return the snapshot summary line, or None
+    values = parse_key_arguments(argument, snapshot_defaults, "snapshot", app_log)
+    if values is None:
+        return None
+    snapshot = dict(snapshot_defaults)
+    snapshot.update(values)
+    if not 1 <= snapshot["quality"] <= 100 or not 1 <= snapshot["chunk"] <= g_max_snapshot_chunk:
+        app_log.error("snapshot: %s not valid", snapshot)
+        return None
+    try:
+        camera = get_camera(app_log)
+    except Exception as e:
+        app_log.error(e)
+        return None
+    frame = camera.latest_frame()
+    if frame is None:
+        app_log.error("no camera frame")
+        return None
+    image = camera.encode_jpeg(frame, snapshot["width"], snapshot["height"], snapshot["quality"])
+    if image is None:
+        app_log.error("jpeg encoding failed")
+        return None
+    # kept until the session's next snapshot, so the host can ask for any
+    # chunk again
+    chunks = (len(image) + snapshot["chunk"] - 1) // snapshot["chunk"]
+    g_snapshots[ser_port] = {"image": image, "chunk": snapshot["chunk"], "chunks": chunks}
+    app_log.debug("snapshot: %d bytes in %d chunks", len(image), chunks)
+    return "Snapshot Size=%d Chunks=%d ChunkSize=%d Crc=%08X" % (
+        len(image), chunks, snapshot["chunk"], binascii.crc32(image) & 0xFFFFFFFF)
+
+
+def snapshot_chunk(ser_port, value):
+    # return the header line and payload of chunk number value, or None
+    snapshot = g_snapshots.get(ser_port)
+    if snapshot is None or not value.isdigit() or int(value) >= snapshot["chunks"]:
+        return None
+    index = int(value)
+    payload = snapshot["image"][index * snapshot["chunk"]:(index + 1) * snapshot["chunk"]]
+    header = "Chunk=%d Size=%d Crc=%04X" % (index, len(payload), binascii.crc_hqx(payload, 0xFFFF))
+    return header, payload
+
+
+def read_serial_bytes(ser_port, rx_buffer):
+    # block on the port until at least one byte arrives or the read timeout
+    # expires, partial lines and frames are kept in rx_buffer until they
+    # are complete
+    try:
+        in_bytes = ser_port.read(max(1, ser_port.inWaiting()))
+    except SessionClosed:
+        raise
     except serial.SerialException:
         app_log.error("serial exception detected")
         raise serial.SerialException
@@ -1062,114 +2733,675 @@ def launch_daemon(ser_port, app_log):
         app_log.error(e)
         raise e
 
-    if in_buffer_bytes > 0:
-        app_log.debug("in_buffer_bytes:" + str(in_buffer_bytes))
-    while not g_threads_error_flag:
-        if in_buffer_bytes > 0:
-            in_bytes = None
-            try:
-                in_bytes = ser_port.readline()
-            except Exception as e:
-                app_log.error(e)
-                raise e
-
-            in_bytes = in_bytes.decode('utf-8')
-            app_log.debug("in_bytes:" + in_bytes)
-            in_bytes = in_bytes.rstrip()
-            app_log.debug("in_bytes after rstrip:" + in_bytes)
-
-            if in_bytes != '':
-                app_log.debug("<<" + in_bytes)
-                if in_bytes.find('=') >= 0:
-                    command = in_bytes[:in_bytes.index('=')]
-                    value = in_bytes[in_bytes.index('=') + 1:]
-                    if com_com.get(command) is not None:
-                        app_log.info("Command is: " + command)
-                        app_log.info("Value is:" + str(value))
-                        if signal_function.get(command)(command, value):
-                            app_log.info("Result=OK")
-                            try:
-                                ser_port.flushOutput()
-                                ser_port.write(("Result=OK" + "\r\n").encode('utf-8'))
-                            except Exception as e:
-                                app_log.error(e)
-                                raise e
-                elif in_bytes.find('IP') >= 0:
-                    app_log.debug('ask ip')
-                    try:
-                        ser_port.flushOutput()
-                        ser_port.write((str(get_ip_address('lo')) + "\r\n").encode('utf-8'))
-                    except Exception as e:
-                        app_log.error(e)
-                        raise e
-                elif in_bytes.find('SHUTDOWN') >= 0:
-                    app_log.debug('>>shutdown raspberry pi')
-                    try:
-                        ser_port.flushOutput()
-                        ser_port.write(('shutdown raspberry pi' + "\r\n").encode('utf-8'))
-                    except Exception as e:
-                        app_log.error(e)
-                        raise e
-                    import subprocess
-                    command = '/usr/bin/sudo /sbin/shutdown now'
-                    process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
-                    output = process.communicate()[0]
-                elif in_bytes.find('TAKESNAPSHOT') >= 0:
-                    app_log.debug('take snap shot by camera on raspberry pi')
-                    import cv2
-                    cap = cv2.VideoCapture(0)
-                    ret, im = cap.read()
-                    cv2.imwrite('snapshot.jpg', im)
-                    try:
-                        ser_port.flushOutput()
-                        ser_port.write(('ready to send file' + "\r\n").encode('utf-8'))
-                        app_log.debug('>>ready to send file')
-                    except Exception as e:
-                        app_log.error(e)
-                        cap.release()
-                        raise e
-                    else:
-                        while ser_port.readline().find('ready to receive file') < 0:
-                            pass
-                        app_log.debug('ready to receive file')
-                        fd = open('snapshot.jpg', "rb")
-                        ser_port.write(fd.read())
-                        fd.close()
-                        ser_port.write('\n<<EOF>>\n')
-                        cap.release()
-                        app_log.debug('sending file finished')
-                elif in_bytes.find('SIGNALCHECK') >= 0:
-                    check_signal_gpio_pins(ser_port)
-                    speed_sweeping(ser_port)
-                    button_check(ser_port)
-                else:
-                    app_log.info(">>Result=Fail")
-                    try:
-                        ser_port.flushOutput()
-                        ser_port.write(("Result=Fail" + "\r\n").encode('utf-8'))
-                    except Exception as e:
-                        app_log.error(e)
-                        raise e
-
-        time.sleep(0.1)
+    if in_bytes:
+        rx_buffer.extend(in_bytes)
+    return len(in_bytes)
+
+
+def pop_serial_line(rx_buffer):
+    # return the first complete line in rx_buffer, or None
+    line_end = rx_buffer.find(b'\n')
+    if line_end < 0:
+        return None
+    line = bytes(rx_buffer[:line_end + 1])
+    del rx_buffer[:line_end + 1]
+    return line
+
+
+def pop_binary_frame(rx_buffer):
+    # return the first complete binary frame in rx_buffer, or None. bytes
+    # in front of the frame magic are dropped to resynchronise.
+    while True:
+        magic_index = rx_buffer.find(bytearray([binary_frame_magic]))
+        if magic_index < 0:
+            del rx_buffer[:]
+            return None
+        if magic_index > 0:
+            app_log.warning("dropped %d bytes before binary frame", magic_index)
+            del rx_buffer[:magic_index]
+        if len(rx_buffer) < binary_frame_header.size:
+            return None
+        magic, command_id, value_type, sequence = binary_frame_header.unpack_from(bytes(rx_buffer))
+        if value_type == binary_value_int:
+            value_size = binary_int_value.size
+        elif value_type == binary_value_text:
+            if len(rx_buffer) < binary_frame_header.size + 1:
+                return None
+            value_size = 1 + rx_buffer[binary_frame_header.size]
+        else:
+            app_log.warning("binary frame value type: %d not valid", value_type)
+            del rx_buffer[:1]
+            continue
+        frame_size = binary_frame_header.size + value_size + binary_crc.size
+        if len(rx_buffer) < frame_size:
+            return None
+        frame = bytes(rx_buffer[:frame_size])
+        del rx_buffer[:frame_size]
+        return frame
+
+
+def decode_binary_frame(frame):
+    # return (command id, value as text, sequence), value is None when the
+    # frame is corrupted
+    magic, command_id, value_type, sequence = binary_frame_header.unpack_from(frame)
+    crc, = binary_crc.unpack_from(frame, len(frame) - binary_crc.size)
+    if binascii.crc_hqx(frame[:-binary_crc.size], 0xFFFF) != crc:
+        return command_id, None, sequence
+    value_bytes = frame[binary_frame_header.size:-binary_crc.size]
+    if value_type == binary_value_int:
+        value = str(binary_int_value.unpack(value_bytes)[0])
+    else:
+        # a value that is not utf-8 fails validation like any other
+        value = value_bytes[1:].decode('utf-8', 'replace')
+    return command_id, value, sequence
+
+
+def encode_binary_ack(sequence, status):
+    ack = binary_ack_header.pack(binary_ack_magic, sequence, status)
+    return ack + binary_crc.pack(binascii.crc_hqx(ack, 0xFFFF))
+
+
+def serial_write_line(ser_port, line):
+    serial_write_bytes(ser_port, (line + "\r\n").encode('utf-8'))
+
+
+def serial_write_bytes(ser_port, out_bytes):
+    # responses and progress lines of background jobs share the port
+    serial_lock = g_serial_locks[ser_port]
+    serial_lock.acquire()
+    try:
+        ser_port.write(out_bytes)
+    except Exception as e:
+        app_log.error(e)
+        raise e
+    finally:
+        serial_lock.release()
+
+
+def parse_batch_line(in_bytes):
+    # split "Command=Value;Command=Value" into (command, value) pairs,
+    # return None when any item is not a Command=Value pair
+    settings = []
+    for item in in_bytes.split(';'):
+        item = item.strip()
+        if item == '':
+            continue
+        if item.find('=') < 0:
+            return None
+        settings.append((item[:item.index('=')], item[item.index('=') + 1:]))
+    return settings
+
+
+def traced_setting(trace, setting_function, *args):
+    # run a setter with trace attached to the commands it submits
+    g_command_context.trace = trace
+    g_command_context.settings = None
+    try:
+        return setting_function(*args)
+    finally:
+        g_command_context.trace = None
+
+
+def state_dump(since):
+    # DUMP lines of everything changed after version since, None when since
+    # is ahead of the current version. the version is taken before the
+    # values, a change racing the dump is reported again on the next poll.
+    version = g_state_versions.version
+    if since > version:
+        return None
+    changed = g_state_versions.changed_since(since) if since > 0 else None
+    lines = ["State Version=%d" % version]
+    for command in com_com:
+        if changed is None or ("Setting", command) in changed:
+            lines.append("Setting %s=%s" % (command, com_setting[command]))
+    g_lock.acquire()
+    try:
+        for pin in sorted(g_pin_table):
+            if changed is None or ("Pin", pin) in changed:
+                lines.append("Pin %s=%s" % (pin.strip(), g_pin_levels[g_pin_table[pin]]))
+        if changed is None or ("Duty", var_speed) in changed:
+            lines.append("Duty %s=%s" % (var_speed, g_speed_duty))
+    finally:
+        g_lock.release()
+    return lines
+
+
+def deferred_setting(trace, setting_function, *args):
+    # run a setter without waiting for its commands, return the setter's
+    # result and the handles of the commands it submitted
+    g_command_context.deferred = []
+    try:
+        return traced_setting(trace, setting_function, *args), g_command_context.deferred
+    finally:
+        g_command_context.deferred = None
+
+
+def pipeline_ack_service(ser_port, ack_queue, app_log):
+    # acks tagged commands in the order they were read, each once all the
+    # commands it submitted are applied
+    while True:
+        item = ack_queue.get()
+        if item is None:
+            ack_queue.task_done()
+            return
+        tag, command, handles, reason, trace = item
+        error = None
+        for handle in handles:
+            if not wait_command(handle) and reason is None:
+                reason = "ApplyFailed"
+                error = handle.error
         try:
-            in_buffer_bytes = ser_port.inWaiting()
-        except serial.SerialException:
-            app_log.error("serial exception detected")
-            raise serial.SerialException
+            if reason is None:
+                serial_write_line(ser_port, "#%s Result=OK" % tag)
+                trace.mark("acked")
+            elif error is not None:
+                serial_write_line(ser_port, "#%s Result=Fail Reason=%s Error=%s" % (tag, reason, error))
+            else:
+                serial_write_line(ser_port, "#%s Result=Fail Reason=%s" % (tag, reason))
         except Exception as e:
-            app_log.error(e)
-            raise e
-        if in_buffer_bytes > 0:
-            app_log.debug("in_buffer_bytes:" + str(in_buffer_bytes))
+            # the session notices the broken port itself, keep draining so
+            # it never blocks on a full queue
+            app_log.error("ack #%s not sent: %s", tag, e)
+        if command is not None:
+            g_stats.record(command, trace)
+        ack_queue.task_done()
+
+
+def handle_tagged_line(ser_port, tag, in_bytes, app_log, trace):
+    # "#<tag> Command=Value" or "#<tag> Command=Value;Command=Value" is
+    # applied in order with the other lines, but acked by the session's ack
+    # thread so the host can keep sending
+    ack_queue = g_ack_queues.get(ser_port)
+    if ack_queue is None:
+        ack_queue = queue.Queue(g_pipeline_depth)
+        t = threading.Thread(target=pipeline_ack_service, args=(ser_port, ack_queue, app_log))
+        t.daemon = True
+        t.start()
+        g_ack_queues[ser_port] = ack_queue
+
+    command = None
+    handles = []
+    reason = None
+    if in_bytes.find(';') >= 0:
+        settings = parse_batch_line(in_bytes)
+        trace.mark("parsed")
+        command = "Batch"
+        if not settings:
+            reason = "InvalidBatch"
+        else:
+            result, handles = deferred_setting(trace, batch_setting, settings)
+            if not result:
+                reason = "InvalidValue"
+    elif in_bytes.find('=') >= 0 and com_com.get(in_bytes[:in_bytes.index('=')]) is not None:
+        command = in_bytes[:in_bytes.index('=')]
+        trace.mark("parsed")
+        result, handles = deferred_setting(trace, signal_function.get(command), command,
+                                           in_bytes[in_bytes.index('=') + 1:])
+        if not result:
+            reason = "InvalidValue"
+    else:
+        reason = "NotPipelined"
+    # blocks while g_pipeline_depth acks are outstanding
+    ack_queue.put((tag, command, handles, reason, trace))
+
+
+def wait_pipeline_acks(ser_port):
+    # untagged lines are answered after every tagged line read before them
+    ack_queue = g_ack_queues.get(ser_port)
+    if ack_queue is not None:
+        ack_queue.join()
+
+
+def applied_state():
+    # com_setting, pin levels and speed duty as saved to the state file.
+    # pins that blink are left out, restarting signal generation brings
+    # them back.
+    g_lock.acquire()
+    try:
+        blinking_pins = g_periodic_signals.active_pins()
+        pins = {}
+        for pin, pin_num in g_pin_table.items():
+            if pin not in blinking_pins and g_pin_levels[pin_num] is not None:
+                pins[pin.strip()] = g_pin_levels[pin_num]
+        return {"settings": dict(com_setting), "pins": pins, "duty": g_speed_duty}
+    finally:
+        g_lock.release()
+
+
+def stats_report():
+    lines = g_stats.report()
+    lines.append("Stats Restarts=%d WatchdogTrips=%d" % (g_supervisor.restarts, g_supervisor.watchdog_trips))
+    lines.append("Stats QueueDepth=%d QueueHighWater=%d" % (g_queue.qsize(), g_queue.high_water))
+    lines.append("Stats Coalesced " + " ".join(
+        [command + "=" + str(g_queue.coalesced[command]) for command in coalescing_commands]))
+    return lines
+
+
+def start_job(ser_port, job):
+    # the job only starts after its Result=OK is written
+    if job is not None:
+        serial_write_line(ser_port, "Result=OK")
+        job.start()
+    else:
+        serial_write_line(ser_port, "Result=Fail")
+
+
+def handle_serial_line(ser_port, in_bytes, app_log, trace=None):
+    if trace is None:
+        trace = CommandTrace()
+    # a stray byte on the line turns into U+FFFD and the line fails as an
+    # unknown command instead of ending the session
+    in_bytes = in_bytes.decode('utf-8', 'replace')
+    app_log.debug("in_bytes: %s", in_bytes)
+    in_bytes = in_bytes.rstrip()
+    app_log.debug("in_bytes after rstrip: %s", in_bytes)
+
+    if in_bytes.startswith('#') and in_bytes.find(' ') > 1:
+        app_log.debug("<<%s", in_bytes)
+        handle_tagged_line(ser_port, in_bytes[1:in_bytes.index(' ')],
+                           in_bytes[in_bytes.index(' ') + 1:].strip(), app_log, trace)
+    elif in_bytes != '':
+        app_log.debug("<<%s", in_bytes)
+        wait_pipeline_acks(ser_port)
+        if in_bytes.startswith('SCENARIO '):
+            if scenario_setting(ser_port, in_bytes[len('SCENARIO '):].strip()):
+                serial_write_line(ser_port, "Result=OK")
+            else:
+                serial_write_line(ser_port, "Result=Fail")
+        elif in_bytes == 'RUN':
+            start_job(ser_port, scenario_run(ser_port, app_log))
+        elif in_bytes.startswith('SIGNALCHECK'):
+            start_job(ser_port, signal_check_start(ser_port, in_bytes[len('SIGNALCHECK'):], app_log))
+        elif in_bytes.startswith('SWEEP'):
+            start_job(ser_port, sweep_start(ser_port, in_bytes[len('SWEEP'):], app_log))
+        elif in_bytes.startswith('TAKESNAPSHOT'):
+            app_log.debug('take snap shot by camera on raspberry pi')
+            summary = take_snapshot(ser_port, in_bytes[len('TAKESNAPSHOT'):], app_log)
+            if summary is not None:
+                serial_write_line(ser_port, summary)
+                serial_write_line(ser_port, "Result=OK")
+            else:
+                serial_write_line(ser_port, "Result=Fail")
+        elif in_bytes == 'ABORT':
+            # stops whichever of the session's scenario, signal check and
+            # sweep is running
+            aborted = [scenario_abort(ser_port), signal_check_abort(ser_port), sweep_abort(ser_port)]
+            if True in aborted:
+                serial_write_line(ser_port, "Result=OK")
+            else:
+                serial_write_line(ser_port, "Result=Fail")
+        elif in_bytes == 'DUMP' or in_bytes.startswith('DUMP?since='):
+            # DUMP returns the whole state, DUMP?since=<version> only what
+            # changed after that version
+            since = in_bytes[len('DUMP?since='):]
+            lines = None
+            if in_bytes == 'DUMP':
+                lines = state_dump(0)
+            elif since.isdigit():
+                lines = state_dump(int(since))
+            if lines is not None:
+                for line in lines:
+                    serial_write_line(ser_port, line)
+                serial_write_line(ser_port, "Result=OK")
+            else:
+                serial_write_line(ser_port, "Result=Fail")
+        elif in_bytes.find(';') >= 0:
+            settings = parse_batch_line(in_bytes)
+            trace.mark("parsed")
+            app_log.info("Batch is: %s", settings)
+            if settings and traced_setting(trace, batch_setting, settings):
+                app_log.info("Result=OK")
+                serial_write_line(ser_port, "Result=OK")
+                trace.mark("acked")
+            else:
+                app_log.info(">>Result=Fail")
+                serial_write_line(ser_port, "Result=Fail")
+            g_stats.record("Batch", trace)
+        elif in_bytes.find('=') >= 0:
+            command = in_bytes[:in_bytes.index('=')]
+            value = in_bytes[in_bytes.index('=') + 1:]
+            trace.mark("parsed")
+            if com_com.get(command) is not None:
+                app_log.info("Command is: %s", command)
+                app_log.info("Value is: %s", value)
+                if traced_setting(trace, signal_function.get(command), command, value):
+                    app_log.info("Result=OK")
+                    serial_write_line(ser_port, "Result=OK")
+                    trace.mark("acked")
+                else:
+                    # the command was not valid, or was not applied within
+                    # g_command_timeout
+                    app_log.info(">>Result=Fail")
+                    serial_write_line(ser_port, "Result=Fail")
+                g_stats.record(command, trace)
+            elif command == "LOGLEVEL":
+                if log_level_setting(value):
+                    serial_write_line(ser_port, "Result=OK")
+                else:
+                    serial_write_line(ser_port, "Result=Fail")
+            elif command == "GET":
+                if com_com.get(value) is not None:
+                    serial_write_line(ser_port, "%s=%s Version=%d" % (
+                        value, com_setting[value], g_state_versions.version))
+                    serial_write_line(ser_port, "Result=OK")
+                else:
+                    serial_write_line(ser_port, "Result=Fail")
+            elif command == "CHUNK":
+                # the host pulls one chunk at a time and asks again for any
+                # chunk whose crc does not match. the header line is
+                # followed by Size raw bytes.
+                chunk = snapshot_chunk(ser_port, value)
+                if chunk is not None:
+                    serial_write_bytes(ser_port, (chunk[0] + "\r\n").encode('utf-8') + chunk[1])
+                else:
+                    serial_write_line(ser_port, "Result=Fail")
+        elif in_bytes == 'BINARY':
+            app_log.info("switch to binary protocol")
+            serial_write_line(ser_port, "Result=OK")
+            g_binary_ports.add(ser_port)
+        elif in_bytes.find('STATS') >= 0:
+            if in_bytes.find('RESET') >= 0:
+                app_log.debug('reset stats')
+                g_stats.reset()
+                g_queue.reset_stats()
+            else:
+                app_log.debug('ask stats')
+                for line in stats_report():
+                    serial_write_line(ser_port, line)
+            serial_write_line(ser_port, "Result=OK")
+        elif in_bytes.find('IP') >= 0:
+            app_log.debug('ask ip')
+            serial_write_line(ser_port, str(get_ip_address('lo')))
+        elif in_bytes.find('SHUTDOWN') >= 0:
+            app_log.debug('>>shutdown raspberry pi')
+            serial_write_line(ser_port, 'shutdown raspberry pi')
+            import subprocess
+            command = '/usr/bin/sudo /sbin/shutdown now'
+            process = subprocess.Popen(command.split(), stdout=subprocess.PIPE)
+            output = process.communicate()[0]
+        else:
+            app_log.info(">>Result=Fail")
+            serial_write_line(ser_port, "Result=Fail")
+
+
+def handle_binary_frame(ser_port, frame, app_log, trace):
+    command_id, value, sequence = decode_binary_frame(frame)
+    trace.mark("parsed")
+    if value is None:
+        app_log.error("binary frame %d crc error", sequence)
+        status = binary_status_error
+    elif command_id == binary_text_mode_id:
+        app_log.info("back to text protocol")
+        g_binary_ports.discard(ser_port)
+        status = binary_status_ok
+    elif command_id >= len(binary_commands):
+        app_log.error("binary command id: %d not valid", command_id)
+        status = binary_status_error
+    else:
+        command = binary_commands[command_id]
+        app_log.info("Command is: %s", command)
+        app_log.info("Value is: %s", value)
+        if traced_setting(trace, signal_function.get(command), command, value):
+            status = binary_status_ok
+        else:
+            status = binary_status_fail
+    serial_write_bytes(ser_port, encode_binary_ack(sequence, status))
+    if status == binary_status_ok:
+        trace.mark("acked")
+    if value is not None and command_id < len(binary_commands):
+        g_stats.record(binary_commands[command_id], trace)
+
+
+class SessionClosed(serial.SerialException):
+    # the peer of a socket session hung up
+    pass
+
+
+class SocketPort(object):
+    # the part of the serial.Serial interface the sessions use, on top of a
+    # connected TCP or unix socket
+
+    def __init__(self, sock, name):
+        self._sock = sock
+        self.name = name
+        self.timeout = g_serial_read_timeout
+
+    def inWaiting(self):
+        if not select.select([self._sock], [], [], 0)[0]:
+            return 0
+        return len(self._sock.recv(65536, socket.MSG_PEEK))
+
+    def read(self, size=1):
+        # like serial.Serial, return b'' when nothing arrives within timeout
+        if not select.select([self._sock], [], [], self.timeout)[0]:
+            return b''
+        in_bytes = self._sock.recv(size)
+        if not in_bytes:
+            raise SessionClosed("%s closed by peer" % self.name)
+        return in_bytes
+
+    def write(self, out_bytes):
+        self._sock.sendall(out_bytes)
+        return len(out_bytes)
+
+    def flushInput(self):
+        pass
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        self._sock.close()
+
+
+def init_listener(app_log, address):
+    # address is tcp:<host>:<port> or unix:<path>
+    family, _, location = address.partition(':')
+    if family == "tcp":
+        host, _, port = location.rpartition(':')
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, int(port)))
+    elif family == "unix":
+        if os.path.exists(location):
+            os.unlink(location)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(location)
+    else:
+        raise ValueError("listen address: %s not valid" % address)
+    listener.listen(g_listen_backlog)
+    app_log.info("listening on %s", address)
+    return listener
+
+
+def accept_sessions(listener, app_log):
+    # every client gets its own session thread, as a serial port does
+    while True:
+        sock, peer = listener.accept()
+        if sock.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            name = "tcp:%s:%d" % peer
+        else:
+            name = "unix:%d" % sock.fileno()
+        t = threading.Thread(target=run_socket_session, args=(SocketPort(sock, name), app_log))
+        t.daemon = True
+        t.start()
+
+
+def run_socket_session(sock_port, app_log):
+    try:
+        run_session(sock_port, app_log)
+    finally:
+        sock_port.close()
+
+
+def open_session(ser_port):
+    g_serial_locks.setdefault(ser_port, threading.Lock())
+
+
+def close_session(ser_port):
+    g_binary_ports.discard(ser_port)
+    g_snapshots.pop(ser_port, None)
+    scenario = g_scenarios.pop(ser_port, None)
+    if scenario is not None:
+        scenario["abort"].set()
+    ack_queue = g_ack_queues.pop(ser_port, None)
+    if ack_queue is not None:
+        ack_queue.put(None)
+
+
+def run_session(ser_port, app_log):
+    # one thread per port, a port that fails is closed without stopping the
+    # other sessions
+    app_log.info("session %s started", ser_port.name)
+    try:
+        launch_daemon(ser_port, app_log)
+    except SessionClosed as e:
+        app_log.info(e)
+    except Exception as e:
+        app_log.error("session %s failed: %s", ser_port.name, e)
+    finally:
+        close_session(ser_port)
+    app_log.info("session %s stopped", ser_port.name)
+
+
+def launch_daemon(ser_port, app_log):
+    open_session(ser_port)
+    ser_port.flushInput()
+    ser_port.flushOutput()
+    rx_buffer = bytearray()
+    # the host waits for this line instead of guessing how long boot takes
+    serial_write_line(ser_port, "READY")
+
+    while not g_threads_error_flag:
+        read_serial_bytes(ser_port, rx_buffer)
+        received = monotonic()
+        while not g_threads_error_flag:
+            # the protocol can switch after any line or frame, so take them
+            # out of the buffer one at a time
+            if ser_port in g_binary_ports:
+                frame = pop_binary_frame(rx_buffer)
+                if frame is None:
+                    break
+                try:
+                    handle_binary_frame(ser_port, frame, app_log, CommandTrace(received))
+                except serial.SerialException:
+                    raise
+                except Exception:
+                    # the host times out on the missing ack and resends
+                    app_log.exception("binary frame failed")
+            else:
+                in_bytes = pop_serial_line(rx_buffer)
+                if in_bytes is None:
+                    break
+                try:
+                    handle_serial_line(ser_port, in_bytes, app_log, CommandTrace(received))
+                except serial.SerialException:
+                    raise
+                except Exception:
+                    # one bad line fails on its own, a port that cannot be
+                    # written any more ends the session from here
+                    app_log.exception("line %r failed", in_bytes)
+                    serial_write_line(ser_port, "Result=Fail")
+
+
+def parse_arguments():
+    import argparse
+    parser = argparse.ArgumentParser(description="ebike panel test signal daemon")
+    parser.add_argument("--port", nargs="*", default=["/dev/ttyUSB0"],
+                        help="serial ports the hosts are connected to, one session each, a pty works as well. "
+                             "--port without a value serves the --listen sockets only")
+    parser.add_argument("--listen", action="append", default=[],
+                        help="also accept sessions on tcp:<host>:<port> or unix:<path>, can be repeated")
+    parser.add_argument("--backend", default="rpi", choices=sorted(gpio_backends.keys()),
+                        help="rpi drives the pins through RPi.GPIO, sim records them in memory")
+    parser.add_argument("--speed-pwm", default="gpio", choices=["gpio", "sysfs"],
+                        help="sysfs drives the speed signal with a hardware PWM through the kernel pwm interface")
+    parser.add_argument("--pwm-sysfs-root", default="/sys/class/pwm",
+                        help="pwm sysfs directory, a fake tree works for testing")
+    parser.add_argument("--pwm-chip", type=int, default=0)
+    parser.add_argument("--pwm-channel", type=int, default=0)
+    parser.add_argument("--pwm-jitter", type=int, metavar="PIN",
+                        help="measure the period jitter of the speed PWM on this input pin, wired to the "
+                             "PWM output, and exit. run once with each --speed-pwm to compare them")
+    parser.add_argument("--pwm-jitter-seconds", type=float, default=10.0)
+    parser.add_argument("--log-level", default="DEBUG", choices=log_level_options,
+                        help="initial log level, can be changed at runtime with LOGLEVEL=<level>")
+    parser.add_argument("--async-log", action="store_true",
+                        help="write the log file from a background thread, needs python 3.2")
+    parser.add_argument("--camera", type=int, default=0,
+                        help="video device index used by TAKESNAPSHOT")
+    parser.add_argument("--command-timeout", type=float, default=g_command_timeout,
+                        help="seconds a command may take before its worker is replaced")
+    parser.add_argument("--state-file",
+                        help="save the applied state to this file after every change")
+    parser.add_argument("--restore", action="store_true",
+                        help="start from the state saved in --state-file instead of the defaults")
+    parser.add_argument("--prewarm", nargs="*", default=[], choices=prewarm_options,
+                        help="load these in the background after startup instead of on first use")
+    args = parser.parse_args()
+    if args.restore and args.state_file is None:
+        parser.error("--restore needs --state-file")
+    if args.async_log and cur_version < (3, 2):
+        parser.error("--async-log needs python 3.2")
+    return args
 
 
 if __name__ == '__main__':
-    app_log = init_logging()
+    startup_begin = monotonic()
+    args = parse_arguments()
+    app_log = init_logging(logging.getLevelName(args.log_level), args.async_log)
+    phase_start = startup_phase(app_log, "logging", startup_begin)
     init_global_variables()
+    g_camera_device = args.camera
+    g_command_timeout = args.command_timeout
     init_signal_generation_service(app_log)
-    init_gpio_pins(app_log)
-
-    serial_port = init_serial(app_log)
-    if serial_port is not None:
-        launch_daemon(serial_port, app_log)
+    phase_start = startup_phase(app_log, "signal generation service", phase_start)
+    # the pin reserved for the hardware PWM is left out of the pin table
+    # the restore builds
+    if args.speed_pwm == "sysfs":
+        init_speed_pwm(app_log, args.pwm_sysfs_root, args.pwm_chip, args.pwm_channel)
+    restored_levels = None
+    if args.restore:
+        state = load_state(app_log, args.state_file)
+        if state is not None:
+            restored_levels = restore_state(app_log, state)
+    init_gpio_backend(app_log, args.backend)
+    init_gpio_pins(app_log, restored_levels)
+    if args.pwm_jitter is not None:
+        jitter = measure_pwm_jitter(app_log, args.pwm_jitter, args.pwm_jitter_seconds)
+        if jitter is None:
+            sys.exit(1)
+        print("PwmJitter Backend=%s Periods=%d Mean=%.1fus StdDev=%.1fus P99=%.1fus Max=%.1fus" % (
+            args.speed_pwm, jitter["periods"], jitter["mean"], jitter["stddev"], jitter["p99"], jitter["max"]))
+        sys.exit(0)
+    if restored_levels is not None:
+        reapply_state(app_log)
+    phase_start = startup_phase(app_log, "gpio", phase_start)
+    if args.state_file is not None:
+        init_state_persister(app_log, args.state_file)
+
+    sessions = []
+    for port_name in args.port:
+        try:
+            serial_port = init_serial(app_log, port_name)
+        except serial.SerialException:
+            app_log.error("port %s skipped", port_name)
+            continue
+        if serial_port is not None:
+            t = threading.Thread(target=run_session, args=(serial_port, app_log))
+            t.daemon = True
+            t.start()
+            sessions.append(t)
+    for address in args.listen:
+        t = threading.Thread(target=accept_sessions, args=(init_listener(app_log, address), app_log))
+        t.daemon = True
+        t.start()
+        sessions.append(t)
+    startup_phase(app_log, "sessions", phase_start)
+    startup_phase(app_log, "total", startup_begin)
+    init_prewarm(app_log, args.prewarm)
+    # join with a timeout so the main thread still sees KeyboardInterrupt
+    while True in [t.is_alive() for t in sessions]:
+        for t in sessions:
+            t.join(1.0)
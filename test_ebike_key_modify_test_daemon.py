@@ -0,0 +1,589 @@
+import binascii
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import ebike_key_modify_test_daemon as daemon
+
+
+class FakePort(object):
+    # collects what the daemon writes to a session
+
+    name = "fake"
+
+    def __init__(self):
+        self.written = b""
+
+    def write(self, out_bytes):
+        self.written += out_bytes
+
+    def lines(self):
+        return self.written.decode('utf-8').split("\r\n")[:-1]
+
+
+def setUpModule():
+    daemon.app_log = logging.getLogger("ebike_test")
+    daemon.app_log.addHandler(logging.NullHandler())
+    daemon.g_restart_backoff = 0.01
+    daemon.init_global_variables()
+    daemon.init_signal_generation_service(daemon.app_log)
+    daemon.init_gpio_backend(daemon.app_log, "sim")
+    daemon.init_gpio_pins(daemon.app_log)
+
+
+def pin_level(pin):
+    return daemon.g_pin_levels[daemon.g_pin_table[pin]]
+
+
+def set_command(command, value):
+    return daemon.signal_function[command](command, value)
+
+
+def settle_outputs():
+    # wait for the deferred speed stop and button press
+    while len(daemon.g_deferred_outputs) > 0:
+        time.sleep(0.005)
+
+
+def reset_state():
+    # outputs and settings as after startup
+    daemon.drive_safe_state(daemon.app_log)
+    settle_outputs()
+    for command, value in daemon.com_com.items():
+        daemon.com_setting[command] = value
+    daemon.select_speed_duty_lut(daemon.com_setting["RatedVoltage"])
+    daemon.g_queue.reset_stats()
+
+
+def one_wire_bits(transitions, frame_length):
+    # decode the frames sent on the one_wire pin back into bits. a frame
+    # starts after a sync low and every high phase is one bit. the edges of
+    # a frame are due at fixed offsets from its start and can only be late,
+    # so each falling edge is read against the earliest rising edge of the
+    # frame. a late edge can then turn a 0 into a 1 but never the other way
+    pin_num = daemon.g_pin_table[daemon.var_one_wire]
+    edges = [(at, value) for at, pin, event, value in transitions if pin == pin_num and event == "level"]
+    bit_length = sum(daemon.one_wire_bit_timing[0])
+    threshold = (daemon.one_wire_bit_timing[0][0] + daemon.one_wire_bit_timing[1][0]) / 2
+    frames = []
+    phases = None
+    for (at, level), (next_at, _) in zip(edges, edges[1:]):
+        if level == daemon.PIN_LOW and next_at - at > daemon.one_wire_sync / 2:
+            phases = []
+        elif level == daemon.PIN_HIGH and phases is not None:
+            phases.append((at - len(phases) * bit_length, next_at - len(phases) * bit_length))
+            if len(phases) == frame_length * 8:
+                begin = min([rise for rise, fall in phases])
+                frames.append("".join(["1" if fall - begin > threshold else "0" for rise, fall in phases]))
+                phases = None
+    return frames
+
+
+def sent_one_wire_frame(frame_length):
+    # a bit is only a 1 when it was read as one in every frame sent since
+    # the transitions were cleared
+    frames = one_wire_bits(daemon.g_gpio.transitions, frame_length)
+    bits = "".join([min(column) for column in zip(*frames)])
+    return bytearray([int(bits[i:i + 8], 2) for i in range(0, len(bits), 8)])
+
+
+def wait_one_wire_frames(count):
+    frames = daemon.g_one_wire.frames + count
+    while daemon.g_one_wire.frames < frames:
+        time.sleep(0.01)
+
+
+class SignalGenerationTest(unittest.TestCase):
+
+    def setUp(self):
+        reset_state()
+
+    def test_simulated_backend_records_transitions(self):
+        daemon.g_gpio.transitions.clear()
+        self.assertTrue(daemon.batch_setting([("Signal", "Start"), ("Gear", "High")]))
+        transitions = list(daemon.g_gpio.transitions)
+        pin_num = daemon.g_pin_table[daemon.var_high_gear]
+        self.assertIn((pin_num, "level", daemon.PIN_HIGH), [transition[1:] for transition in transitions])
+        self.assertIn((daemon.g_pin_table[daemon.var_speed], "start", daemon.speed_duty_cycle(0)),
+                      [transition[1:] for transition in transitions])
+        times = [transition[0] for transition in transitions]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(daemon.g_gpio.input(pin_num), daemon.PIN_HIGH)
+
+    def test_batch(self):
+        self.assertTrue(daemon.batch_setting([("Signal", "Start"), ("Gear", "High"), ("Speed", "30")]))
+        self.assertEqual(pin_level(daemon.var_high_gear), daemon.PIN_HIGH)
+        self.assertEqual(daemon.g_speed_duty, daemon.speed_duty_cycle(30))
+
+    def test_batch_not_valid(self):
+        self.assertFalse(daemon.batch_setting([("Gear", "High"), ("Speed", "x")]))
+        self.assertEqual(daemon.com_setting["Gear"], daemon.com_com["Gear"])
+
+    def test_batch_mode_and_signal(self):
+        self.assertTrue(daemon.batch_setting([("Signal", "Start"), ("Gear", "High")]))
+        self.assertTrue(daemon.batch_setting([("Signal", "Stop"), ("Mode", "1wire")]))
+        self.assertIsNone(daemon.g_speed_duty)
+        self.assertEqual(pin_level(daemon.var_high_gear), daemon.PIN_LOW)
+        self.assertFalse(daemon.g_one_wire.running())
+
+        self.assertTrue(daemon.batch_setting([("Signal", "Start")]))
+        self.assertTrue(daemon.g_one_wire.running())
+        self.assertTrue(daemon.batch_setting([("Mode", "GPIO"), ("Signal", "Stop")]))
+        self.assertFalse(daemon.g_one_wire.running())
+
+    def test_batch_status_and_gear(self):
+        self.assertTrue(daemon.batch_setting([("Signal", "Start"), ("Status", "Ready"), ("Gear", "Low")]))
+        self.assertTrue(daemon.batch_setting([("Status", "Park"), ("Gear", "High")]))
+        # the same levels as Status=Park and Gear=High sent one at a time
+        self.assertEqual(pin_level(daemon.var_parking), daemon.PIN_LOW)
+        self.assertEqual(pin_level(daemon.var_low_gear), daemon.PIN_LOW)
+        self.assertEqual(pin_level(daemon.var_high_gear), daemon.PIN_HIGH)
+        for pin, level in daemon.desired_signal_levels().items():
+            self.assertEqual(pin_level(pin), level)
+
+    def test_coalescing(self):
+        self.assertTrue(set_command("Signal", "Start"))
+        handles = []
+        # the worker blocks on g_lock with the first update, the later ones
+        # wait in the queue
+        daemon.g_lock.acquire()
+        try:
+            for speed in ["10", "20", "30", "40"]:
+                result, deferred = daemon.deferred_setting(daemon.CommandTrace(), set_command, "Speed", speed)
+                self.assertTrue(result)
+                handles.extend(deferred)
+                time.sleep(0.01)
+        finally:
+            daemon.g_lock.release()
+        for handle in handles:
+            self.assertTrue(handle.wait(1.0))
+        self.assertGreater(daemon.g_queue.coalesced["Speed"], 0)
+        self.assertEqual(daemon.g_speed_duty, daemon.speed_duty_cycle(40))
+
+    def test_pipelined_acks(self):
+        port = FakePort()
+        daemon.open_session(port)
+        try:
+            daemon.handle_serial_line(port, b"#1 Gear=High\r\n", daemon.app_log)
+            daemon.handle_serial_line(port, b"#2 Beam=Low;Status=Ready\r\n", daemon.app_log)
+            daemon.handle_serial_line(port, b"#3 Gear=Nope\r\n", daemon.app_log)
+            daemon.handle_serial_line(port, b"GET=Gear\r\n", daemon.app_log)
+        finally:
+            daemon.close_session(port)
+        lines = port.lines()
+        self.assertEqual(lines[:3], ["#1 Result=OK", "#2 Result=OK", "#3 Result=Fail Reason=InvalidValue"])
+        self.assertTrue(lines[3].startswith("Gear=High "))
+        self.assertEqual(lines[4], "Result=OK")
+
+    def test_dump_since(self):
+        port = FakePort()
+        daemon.open_session(port)
+        try:
+            daemon.handle_serial_line(port, b"DUMP\r\n", daemon.app_log)
+            lines = port.lines()
+            self.assertEqual(lines[-1], "Result=OK")
+            self.assertIn("Setting Gear=%s" % daemon.com_setting["Gear"], lines)
+            self.assertIn("Duty speed=None", lines)
+            version = int(lines[0][len("State Version="):])
+
+            self.assertTrue(set_command("Gear", "High"))
+            port.written = b""
+            daemon.handle_serial_line(port, ("DUMP?since=%d\r\n" % version).encode('utf-8'), daemon.app_log)
+            lines = port.lines()
+            # only what changed after that version
+            self.assertEqual([line for line in lines if line.startswith("Setting ")], ["Setting Gear=High"])
+            self.assertEqual(lines[-1], "Result=OK")
+            version = int(lines[0][len("State Version="):])
+
+            port.written = b""
+            daemon.handle_serial_line(port, ("DUMP?since=%d\r\n" % version).encode('utf-8'), daemon.app_log)
+            self.assertEqual(port.lines(), ["State Version=%d" % version, "Result=OK"])
+            # a version from the future or no version at all
+            port.written = b""
+            daemon.handle_serial_line(port, ("DUMP?since=%d\r\n" % (version + 1)).encode('utf-8'), daemon.app_log)
+            daemon.handle_serial_line(port, b"DUMP?since=x\r\n", daemon.app_log)
+            self.assertEqual(port.lines(), ["Result=Fail", "Result=Fail"])
+        finally:
+            daemon.close_session(port)
+
+    def test_restore(self):
+        self.assertTrue(daemon.batch_setting([("Signal", "Start"), ("Gear", "Low"), ("Speed", "30"),
+                                              ("RatedVoltage", "48"), ("Button", "PressPlus")]))
+        state = daemon.applied_state()
+        state["version"] = daemon.g_state_versions.version
+        reset_state()
+
+        levels = daemon.restore_state(daemon.app_log, state)
+        daemon.init_gpio_pins(daemon.app_log, levels)
+        daemon.reapply_state(daemon.app_log)
+        self.assertEqual(daemon.com_setting["Gear"], "Low")
+        self.assertEqual(pin_level(daemon.var_low_gear), daemon.PIN_HIGH)
+        self.assertEqual(pin_level(daemon.var_button_plus), daemon.PIN_LOW)
+        self.assertEqual(daemon.g_speed_duty, daemon.speed_duty_cycle(30))
+        self.assertGreaterEqual(daemon.g_state_versions.version, state["version"])
+
+    def test_failed_command_rolled_back(self):
+        self.assertTrue(daemon.batch_setting([("Signal", "Start"), ("Button", "PressPlus")]))
+        gear_generation = daemon.gpio_gear_generation
+
+        def failing_gear_generation():
+            raise RuntimeError("gear pins failed")
+
+        daemon.gpio_gear_generation = failing_gear_generation
+        try:
+            self.assertFalse(set_command("Gear", "High"))
+        finally:
+            daemon.gpio_gear_generation = gear_generation
+        self.assertEqual(daemon.com_setting["Gear"], daemon.com_com["Gear"])
+        # the replacing worker presses the held button again
+        self.assertTrue(set_command("Gear", "Low"))
+        self.assertEqual(pin_level(daemon.var_button_plus), daemon.PIN_LOW)
+        self.assertEqual(pin_level(daemon.var_low_gear), daemon.PIN_HIGH)
+
+    def test_recovery_after_failed_termination(self):
+        self.assertTrue(daemon.batch_setting([("Signal", "Start"), ("Beam", "High")]))
+        beam_termination = daemon.gpio_beam_signal_termination
+
+        def failing_beam_termination():
+            # fails once, the recovery's safe state goes through it again
+            daemon.gpio_beam_signal_termination = beam_termination
+            raise RuntimeError("beam pins failed")
+
+        daemon.gpio_beam_signal_termination = failing_beam_termination
+        try:
+            self.assertFalse(set_command("Signal", "Stop"))
+        finally:
+            daemon.gpio_beam_signal_termination = beam_termination
+        # the failed worker left g_lock free, the replacing one takes commands
+        self.assertTrue(set_command("Gear", "High"))
+        self.assertTrue(set_command("Signal", "Start"))
+        self.assertEqual(pin_level(daemon.var_high_gear), daemon.PIN_HIGH)
+        self.assertEqual(pin_level(daemon.var_high_beam), daemon.PIN_HIGH)
+
+    def test_reconfiguration(self):
+        self.assertTrue(daemon.batch_setting([("Signal", "Start"), ("Speed", "30")]))
+        daemon.g_gpio.transitions.clear()
+        self.assertTrue(set_command("RatedVoltage", "48"))
+        events = [event for _, pin_num, event, _ in daemon.g_gpio.transitions if pin_num == 7]
+        # the running PWM only changes its duty cycle
+        self.assertEqual(events, ["duty_cycle"])
+        self.assertEqual(daemon.g_speed_duty, daemon.speed_duty_cycle(30))
+
+        self.assertTrue(set_command("Mode", "1wire"))
+        self.assertIsNone(daemon.g_speed_duty)
+        self.assertTrue(daemon.g_one_wire.running())
+        self.assertTrue(set_command("Mode", "GPIO"))
+        self.assertFalse(daemon.g_one_wire.running())
+        self.assertEqual(daemon.g_speed_duty, daemon.speed_duty_cycle(30))
+
+    def test_one_wire_frames(self):
+        daemon.g_gpio.transitions.clear()
+        self.assertTrue(daemon.batch_setting([("Mode", "1wire"), ("Signal", "Start"), ("Speed", "30")]))
+        frame = daemon.one_wire_frame(daemon.com_setting)
+        wait_one_wire_frames(8)
+        self.assertEqual(sent_one_wire_frame(len(frame)), frame)
+
+        for command, value in [("CruiserMode", "On"), ("Volt", "42")]:
+            # the frame being sent when the transitions are cleared has lost
+            # its sync, every frame decoded after it is a rebuilt one
+            self.assertTrue(set_command(command, value))
+            daemon.g_gpio.transitions.clear()
+            rebuilt = daemon.one_wire_frame(daemon.com_setting)
+            self.assertNotEqual(rebuilt, frame)
+            wait_one_wire_frames(8)
+            self.assertEqual(sent_one_wire_frame(len(frame)), rebuilt)
+            frame = rebuilt
+
+    def test_periodic_edges(self):
+        scheduler = daemon.PeriodicSignalScheduler()
+        self.addCleanup(scheduler.clear)
+        pin_num = daemon.g_pin_table[daemon.var_turn_left]
+        daemon.g_gpio.transitions.clear()
+        scheduler.set_channel("test", [daemon.var_turn_left], 200)
+        time.sleep(0.55)
+        # the period only changes after the last edge, at the same level
+        scheduler.set_channel("test", [daemon.var_turn_left], 400)
+        time.sleep(0.45)
+        scheduler.clear()
+        edges = [(at, value) for at, pin, event, value in daemon.g_gpio.transitions
+                 if pin == pin_num and event == "level"]
+        self.assertEqual(len(edges), 8)
+        # edges are due every half period from the first one, a late edge
+        # does not push the later ones back
+        begin = edges[0][0]
+        due = [i * 0.1 for i in range(6)] + [0.7, 0.9]
+        for i, (at, level) in enumerate(edges):
+            self.assertLess(abs(at - begin - due[i]), 0.02)
+            self.assertEqual(level, daemon.PIN_HIGH if i % 2 == 0 else daemon.PIN_LOW)
+
+    def test_speed_queued_ahead_of_start(self):
+        self.assertTrue(daemon.batch_setting([("Signal", "Start"), ("Speed", "10")]))
+        self.assertTrue(set_command("Signal", "Stop"))
+        settle_outputs()
+        daemon.g_gpio.transitions.clear()
+        # Speed=30 is applied after Signal=Start is already in com_setting
+        # but before the PWM is started again
+        daemon.g_lock.acquire()
+        try:
+            handles = []
+            for command, value in [("Speed", "30"), ("Signal", "Start")]:
+                result, deferred = daemon.deferred_setting(daemon.CommandTrace(), set_command, command, value)
+                self.assertTrue(result)
+                handles.extend(deferred)
+        finally:
+            daemon.g_lock.release()
+        for handle in handles:
+            self.assertTrue(handle.wait(1.0))
+        events = [event for _, pin_num, event, _ in daemon.g_gpio.transitions if pin_num == 7]
+        self.assertEqual(events[-1], "start")
+        self.assertEqual(daemon.g_pwm.duty_cycle, daemon.speed_duty_cycle(30))
+        self.assertEqual(daemon.g_speed_duty, daemon.speed_duty_cycle(30))
+
+    def test_sweep_ends_as_set(self):
+        port = FakePort()
+        daemon.open_session(port)
+        speeds, duty_cycles = daemon.build_speed_sweep(0, 20, 3)
+        self.assertTrue(daemon.run_speed_sweep(port, speeds, duty_cycles, 0.001, 1, threading.Event(), ""))
+        self.assertIsNone(daemon.g_speed_duty)
+        self.assertTrue(daemon.batch_setting([("Signal", "Start"), ("Speed", "10")]))
+        self.assertTrue(daemon.run_speed_sweep(port, speeds, duty_cycles, 0.001, 1, threading.Event(), ""))
+        self.assertEqual(daemon.g_speed_duty, daemon.speed_duty_cycle(10))
+        daemon.close_session(port)
+
+    def test_sweep_and_signal_check_exclusive(self):
+        port = FakePort()
+        daemon.open_session(port)
+        try:
+            job = daemon.signal_check_start(port, "hold=1000", daemon.app_log)
+            job.start()
+            self.assertIsNone(daemon.sweep_start(port, "", daemon.app_log))
+            self.assertIsNone(daemon.signal_check_start(port, "", daemon.app_log))
+            self.assertTrue(daemon.signal_check_abort(port))
+
+            job = daemon.sweep_start(port, "dwell=1000", daemon.app_log)
+            job.start()
+            self.assertIsNone(daemon.signal_check_start(port, "", daemon.app_log))
+            self.assertTrue(daemon.sweep_abort(port))
+        finally:
+            daemon.close_session(port)
+
+    def test_sessions_keep_own_scenario(self):
+        port_a = FakePort()
+        port_b = FakePort()
+        daemon.open_session(port_a)
+        daemon.open_session(port_b)
+        try:
+            self.assertTrue(daemon.scenario_setting(port_a, "ADD 1000 Gear=High"))
+            self.assertTrue(daemon.scenario_setting(port_b, "ADD 0 Gear=Low"))
+            self.assertTrue(daemon.scenario_setting(port_b, "CLEAR"))
+            job = daemon.scenario_run(port_a, daemon.app_log)
+            job.start()
+            self.assertIsNone(daemon.scenario_run(port_b, daemon.app_log))
+            # an ABORT from the other session leaves the scenario running
+            self.assertFalse(daemon.scenario_abort(port_b))
+            self.assertTrue(job.is_alive())
+            self.assertTrue(daemon.scenario_abort(port_a))
+        finally:
+            daemon.close_session(port_a)
+            daemon.close_session(port_b)
+
+    def test_sweep_aborted_by_own_session_only(self):
+        port_a = FakePort()
+        port_b = FakePort()
+        daemon.open_session(port_a)
+        daemon.open_session(port_b)
+        try:
+            job = daemon.sweep_start(port_a, "dwell=1000", daemon.app_log)
+            job.start()
+            self.assertFalse(daemon.sweep_abort(port_b))
+            self.assertTrue(daemon.sweep_abort(port_a))
+        finally:
+            daemon.close_session(port_a)
+            daemon.close_session(port_b)
+
+    def test_holds_do_not_stall_the_worker(self):
+        self.assertTrue(daemon.batch_setting([("Signal", "Start"), ("Button", "PressPlus")]))
+        start = time.time()
+        self.assertTrue(set_command("Button", "None"))
+        self.assertTrue(set_command("Button", "PressMinus"))
+        self.assertTrue(set_command("Signal", "Stop"))
+        self.assertLess(time.time() - start, daemon.g_button_release_hold / 2)
+        # the press waits for the release hold
+        self.assertEqual(pin_level(daemon.var_button_minus), daemon.PIN_HIGH)
+        settle_outputs()
+        self.assertEqual(pin_level(daemon.var_button_minus), daemon.PIN_LOW)
+        self.assertIsNone(daemon.g_pwm.duty_cycle)
+
+    def test_start_during_speed_stop_keeps_pwm(self):
+        self.assertTrue(daemon.batch_setting([("Signal", "Start"), ("Speed", "10")]))
+        daemon.g_gpio.transitions.clear()
+        self.assertTrue(set_command("Signal", "Stop"))
+        self.assertTrue(set_command("Signal", "Start"))
+        settle_outputs()
+        events = [event for _, pin_num, event, _ in daemon.g_gpio.transitions if pin_num == 7]
+        self.assertEqual(events, ["duty_cycle", "duty_cycle"])
+        self.assertEqual(daemon.g_pwm.duty_cycle, daemon.speed_duty_cycle(10))
+
+
+def binary_frame(command, value, sequence):
+    # a frame as the host sends it
+    if isinstance(value, int):
+        value_type = daemon.binary_value_int
+        value = daemon.binary_int_value.pack(value)
+    else:
+        value_type = daemon.binary_value_text
+        value = bytes(bytearray([len(value.encode('utf-8'))])) + value.encode('utf-8')
+    frame = daemon.binary_frame_header.pack(daemon.binary_frame_magic, daemon.binary_commands.index(command),
+                                            value_type, sequence) + value
+    return frame + daemon.binary_crc.pack(binascii.crc_hqx(frame, 0xFFFF))
+
+
+class BinaryFrameTest(unittest.TestCase):
+
+    def test_decode(self):
+        self.assertEqual(daemon.decode_binary_frame(binary_frame("Speed", 30, 7)),
+                         (daemon.binary_commands.index("Speed"), "30", 7))
+        self.assertEqual(daemon.decode_binary_frame(binary_frame("Gear", "High", 0xFFFF)),
+                         (daemon.binary_commands.index("Gear"), "High", 0xFFFF))
+
+    def test_crc_mismatch(self):
+        frame = bytearray(binary_frame("Speed", 30, 7))
+        frame[daemon.binary_frame_header.size] ^= 0x01
+        # the sequence is still there to nack the frame
+        self.assertEqual(daemon.decode_binary_frame(bytes(frame)), (daemon.binary_commands.index("Speed"), None, 7))
+
+    def test_resync(self):
+        first = binary_frame("Gear", "High", 1)
+        second = binary_frame("Speed", 30, 2)
+        # noise, then a magic byte followed by a value type that is not valid
+        rx_buffer = bytearray(b"\x00\x13" + bytes(bytearray([daemon.binary_frame_magic, 0, 9])) + first[:5])
+        self.assertIsNone(daemon.pop_binary_frame(rx_buffer))
+        rx_buffer += first[5:] + second[:3]
+        self.assertEqual(daemon.pop_binary_frame(rx_buffer), first)
+        self.assertIsNone(daemon.pop_binary_frame(rx_buffer))
+        rx_buffer += second[3:]
+        self.assertEqual(daemon.pop_binary_frame(rx_buffer), second)
+        self.assertEqual(len(rx_buffer), 0)
+        rx_buffer += b"noise"
+        self.assertIsNone(daemon.pop_binary_frame(rx_buffer))
+        self.assertEqual(len(rx_buffer), 0)
+
+
+class SysfsPWMTest(unittest.TestCase):
+    # SysfsPWM against a fake pwm sysfs tree, a thread plays udev and the
+    # writes are checked against what the kernel accepts
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.chip_path = os.path.join(self.root, "pwmchip0")
+        os.mkdir(self.chip_path)
+        open(os.path.join(self.chip_path, "export"), "w").close()
+        self.writes = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def play_udev(self):
+        def export():
+            export_path = os.path.join(self.chip_path, "export")
+            while open(export_path).read().strip() == "":
+                time.sleep(0.001)
+            # the channel shows up a little after the export
+            time.sleep(0.02)
+            channel_path = os.path.join(self.chip_path, "pwm0.tmp")
+            os.mkdir(channel_path)
+            for name in ["period", "duty_cycle", "enable"]:
+                with open(os.path.join(channel_path, name), "w") as fd:
+                    fd.write("0\n")
+            os.rename(channel_path, os.path.join(self.chip_path, "pwm0"))
+
+        t = threading.Thread(target=export)
+        t.daemon = True
+        t.start()
+
+    def read(self, name):
+        with open(os.path.join(self.chip_path, "pwm0", name)) as fd:
+            return int(fd.read())
+
+    def open_pwm(self, frequency):
+        pwm = daemon.SysfsPWM(self.root, 0, 0, frequency)
+        write = pwm._write
+
+        def checked_write(name, value):
+            # the kernel refuses a duty cycle longer than the period
+            if name == "duty_cycle":
+                self.assertLessEqual(value, self.read("period"))
+            if name == "period":
+                self.assertLessEqual(self.read("duty_cycle"), value)
+            self.writes.append((name, value))
+            write(name, value)
+
+        pwm._write = checked_write
+        return pwm
+
+    def test_export_start_and_change(self):
+        self.play_udev()
+        pwm = self.open_pwm(61)
+        pwm.start(50.0)
+        self.assertEqual(self.read("enable"), 1)
+        self.assertEqual(self.read("period"), int(round(1e9 / 61)))
+        self.assertEqual(self.read("duty_cycle"), int(round(self.read("period") * 0.5)))
+        # a shorter period is only written once the duty cycle fits in it
+        pwm.ChangeFrequency(1000)
+        self.assertEqual([name for name, _ in self.writes[-3:]], ["duty_cycle", "period", "duty_cycle"])
+        self.assertEqual(self.read("period"), 1000000)
+        self.assertEqual(self.read("duty_cycle"), 500000)
+        pwm.ChangeDutyCycle(20.0)
+        self.assertEqual(self.read("duty_cycle"), 200000)
+
+    def test_stop_and_restart(self):
+        self.play_udev()
+        pwm = self.open_pwm(61)
+        pwm.start(30.0)
+        pwm.stop()
+        self.assertEqual(self.read("enable"), 0)
+        self.assertIsNone(pwm.duty_cycle)
+        # a second instance finds the exported channel and its duty cycle
+        pwm = self.open_pwm(61)
+        pwm.start(10.0)
+        self.assertEqual(self.read("enable"), 1)
+        self.assertEqual(self.read("duty_cycle"), int(round(self.read("period") * 0.1)))
+
+    def test_export_timeout(self):
+        export_timeout = daemon.g_pwm_export_timeout
+        daemon.g_pwm_export_timeout = 0.05
+        try:
+            self.assertRaises(IOError, daemon.SysfsPWM, self.root, 0, 0, 61)
+        finally:
+            daemon.g_pwm_export_timeout = export_timeout
+
+    def test_fallback_to_gpio_pwm(self):
+        daemon.init_speed_pwm(daemon.app_log, os.path.join(self.root, "missing"), 0, 0)
+        self.assertIsNone(daemon.g_speed_pwm_sysfs)
+        # the chip is there but the channel never shows up
+        export_timeout = daemon.g_pwm_export_timeout
+        daemon.g_pwm_export_timeout = 0.05
+        daemon.g_speed_pwm_sysfs = (self.root, 0, 0)
+        try:
+            self.assertIsInstance(daemon.speed_pwm(61), daemon.SimulatedPWM)
+        finally:
+            daemon.g_speed_pwm_sysfs = None
+            daemon.g_pwm_export_timeout = export_timeout
+
+    def test_jitter_stats(self):
+        period = 1.0 / 61
+        edges = [i * period for i in range(100)]
+        edges[50] += 0.0001
+        jitter = daemon.pwm_jitter_stats(edges, 61)
+        self.assertEqual(jitter["periods"], 99)
+        self.assertAlmostEqual(jitter["max"], 100.0, places=3)
+        self.assertAlmostEqual(jitter["mean"], period * 1e6, places=3)
+        self.assertIsNone(daemon.pwm_jitter_stats(edges[:2], 61))
+
+
+if __name__ == '__main__':
+    unittest.main()